@@ -0,0 +1,342 @@
+"""
+Raw response archive, so that pages can be parsed again without fetching them, and content-addressed image store
+"""
+import os
+import gzip
+import json
+import atexit
+import shutil
+import hashlib
+import threading
+from pathlib import Path
+from collections import Counter
+from logging import Logger
+from datetime import datetime, timezone
+from typing import BinaryIO, Iterable, Iterator, Mapping, NamedTuple, Optional, TextIO
+from uuid import uuid4
+from cms_skip import get_canonical_url
+
+DECODED_HEADERS = {"content-encoding", "transfer-encoding", "content-length"}
+
+class KahArchivedResponse(NamedTuple):
+    """One archived response"""
+    url: str
+    status: int
+    reason: str
+    headers: list[tuple[str, str]]
+    date: str
+    data: bytes
+
+class KahArchiveEntry(NamedTuple):
+    """Where a response is stored in the archive"""
+    file: str
+    offset: int
+    length: int
+    status: int
+    date: str
+
+class KahResponseArchive:
+    """Append-only archive of raw responses in rotating WARC files.
+
+    Each response is one WARC/1.1 response record, gzipped on its own so that it can be read back from its offset
+    (the .warc.gz layout other WARC tools expect). Files are named {prefix}-{n:05d}.warc.gz and a new one is started
+    once max_size bytes are reached. index.txt holds one line per record: url, file, offset, length, status and date,
+    tab separated. When a url was archived several times, the last record wins. Records may be added from several
+    threads."""
+
+    def __init__(self,
+                 path_dir: Path,
+                 prefix: str = "responses",
+                 max_size: int = 512 * 1024 * 1024,
+                 compresslevel: int = 6,
+                 logger: Optional[Logger] = None) -> None:
+        self.path_dir = path_dir
+        self.prefix = prefix
+        self.max_size = max_size
+        self.compresslevel = compresslevel
+        self.logger = logger
+        self.path_index = path_dir / "index.txt"
+        self.entries: dict[str, KahArchiveEntry] = {}
+        self._file: Optional[BinaryIO] = None
+        self._file_name = ""
+        self._index: Optional[TextIO] = None
+        self._lock = threading.Lock() # Records are added from worker threads
+        self._load_index()
+        atexit.register(self.close)
+
+    # =======================
+    # Index
+    # =======================
+
+    def _load_index(self) -> None:
+        if not self.path_index.exists():
+            return
+        with open(self.path_index, "r", encoding="utf-8") as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) != 6: # Truncated by a crash
+                    continue
+                url, file, offset, length, status, date = fields
+                self.entries[url] = KahArchiveEntry(file, int(offset), int(length), int(status), date)
+        if self.logger:
+            self.logger.debug(f"Loaded archive index from path={self.path_index}: {len(self.entries)} urls.")
+
+    def __contains__(self, url: str) -> bool:
+        return url in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    # =======================
+    # Writing
+    # =======================
+
+    def _get_file(self) -> BinaryIO:
+        """Current archive file, rotated once it reached max_size"""
+        if self._file is not None and self._file.tell() < self.max_size:
+            return self._file
+        if self._file is not None:
+            self._file.close()
+        self.path_dir.mkdir(parents=True, exist_ok=True)
+        paths = sorted(self.path_dir.glob(f"{self.prefix}-*.warc.gz"))
+        n = int(paths[-1].name[len(self.prefix) + 1:].split(".")[0]) if paths else 0
+        if paths and paths[-1].stat().st_size >= self.max_size:
+            n += 1
+        self._file_name = f"{self.prefix}-{n:05d}.warc.gz"
+        self._file = open(self.path_dir / self._file_name, "ab")
+        if self.logger:
+            self.logger.debug(f"Archiving responses to path={self.path_dir / self._file_name}.")
+        return self._file
+
+    def add(self, url: str, status: int, reason: str, headers: Mapping[str, str] | list[tuple[str, str]], data: bytes) -> None:
+        """Append the response for url to the archive"""
+        date = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        items = list(headers.items()) if isinstance(headers, Mapping) else headers
+        http = f"HTTP/1.1 {status} {reason}\r\n".encode("latin-1", "replace")
+        http += b"".join(f"{k}: {v}\r\n".encode("latin-1", "replace") for k, v in items)
+        http += b"\r\n" + data
+        warc_headers = (
+            "WARC/1.1\r\n"
+            "WARC-Type: response\r\n"
+            f"WARC-Record-ID: <urn:uuid:{uuid4()}>\r\n"
+            f"WARC-Date: {date}\r\n"
+            f"WARC-Target-URI: {url}\r\n"
+            "Content-Type: application/http;msgtype=response\r\n"
+            f"Content-Length: {len(http)}\r\n"
+            "\r\n"
+        )
+        record = gzip.compress(warc_headers.encode("utf-8") + http + b"\r\n\r\n", compresslevel=self.compresslevel)
+
+        with self._lock:
+            f = self._get_file()
+            offset = f.tell()
+            f.write(record)
+            f.flush()
+            if self._index is None:
+                self._index = open(self.path_index, "a", encoding="utf-8")
+            self._index.write(f"{url}\t{self._file_name}\t{offset}\t{len(record)}\t{status}\t{date}\n")
+            self._index.flush()
+            self.entries[url] = KahArchiveEntry(self._file_name, offset, len(record), status, date)
+
+    def add_response(self, resp, data: bytes) -> None:
+        """Append an aiohttp response and its body to the archive"""
+        # data was already decoded by aiohttp, drop the headers describing the encoded body
+        headers = [(k, v) for k, v in resp.headers.items() if k.lower() not in DECODED_HEADERS]
+        self.add(str(resp.url), resp.status, resp.reason or "", headers, data)
+
+    def close(self) -> None:
+        """Close archive and index files"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self._index is not None:
+                self._index.close()
+                self._index = None
+
+    # =======================
+    # Reading
+    # =======================
+
+    @staticmethod
+    def parse_record(record: bytes) -> KahArchivedResponse:
+        """Parse one uncompressed WARC response record"""
+        warc_head, _, rest = record.partition(b"\r\n\r\n")
+        warc = dict(line.split(": ", 1) for line in warc_head.decode("utf-8").split("\r\n")[1:])
+        http = rest[:int(warc["Content-Length"])]
+        http_head, _, data = http.partition(b"\r\n\r\n")
+        status_line, *header_lines = http_head.decode("latin-1").split("\r\n")
+        _, status, reason = (status_line.split(" ", 2) + [""])[:3]
+        headers = [tuple(line.split(": ", 1)) for line in header_lines if line]
+        return KahArchivedResponse(warc["WARC-Target-URI"], int(status), reason, headers, warc["WARC-Date"], data)
+
+    def get(self, url: str) -> Optional[KahArchivedResponse]:
+        """Last archived response for url, None if not archived"""
+        entry = self.entries.get(url)
+        if entry is None:
+            return None
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+        with open(self.path_dir / entry.file, "rb") as f:
+            f.seek(entry.offset)
+            return self.parse_record(gzip.decompress(f.read(entry.length)))
+
+    def __iter__(self) -> Iterator[KahArchivedResponse]:
+        """Last archived response of every url, in archive order"""
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+        entries = sorted(self.entries.values(), key=lambda entry: (entry.file, entry.offset))
+        f: Optional[BinaryIO] = None
+        for entry in entries:
+            if f is None or f.name != str(self.path_dir / entry.file):
+                if f is not None:
+                    f.close()
+                f = open(self.path_dir / entry.file, "rb")
+            f.seek(entry.offset)
+            yield self.parse_record(gzip.decompress(f.read(entry.length)))
+        if f is not None:
+            f.close()
+
+class KahQuarantine:
+    """Store of circles with unsupported fields, kept aside for parser work instead of stopping the crawl.
+
+    The raw xml of each circle goes to path_dir/circle_{id}.xml, and index.jsonl gets one line per circle with its
+    url and unknown tags. counts holds in how many circles each unknown tag was seen in this run."""
+
+    def __init__(self, path_dir: Path, logger: Optional[Logger] = None) -> None:
+        self.path_dir = path_dir
+        self.logger = logger
+        self.counts: Counter[str] = Counter()
+        self.circle_ids: set[str] = set() # Quarantined in this run
+
+    def __len__(self) -> int:
+        return len(self.circle_ids)
+
+    def add(self, circle_id: str, url: str, data: bytes, unknown_tags: list[str]) -> None:
+        self.path_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.path_dir / f"circle_{circle_id}.xml", "wb") as f:
+            f.write(data)
+        if circle_id in self.circle_ids: # Fetched again, e.g. retried
+            return
+        self.circle_ids.add(circle_id)
+        with open(self.path_dir / "index.jsonl", "a", encoding="utf-8") as f:
+            f.write(json.dumps({"circle_id": circle_id, "url": url, "unknown_tags": unknown_tags}, ensure_ascii=False) + "\n")
+        self.counts.update(set(unknown_tags))
+        if self.logger:
+            self.logger.warning(f"Quarantined circle {circle_id} with unsupported fields {unknown_tags} to path={self.path_dir}.")
+
+    def get_summary(self) -> str:
+        """Unknown tags by number of circles, most common first"""
+        return ", ".join(f"{tag} ({n})" for tag, n in self.counts.most_common())
+
+class KahBlobStore:
+    """Content-addressed store of files shared by all events, so that a file is stored and downloaded once.
+
+    Blobs are named by the sha256 of their content under path_dir/{h[:2]}/{h[2:4]}/{h}, and urls.txt maps the urls
+    they were downloaded from to them (url and sha256, tab separated, last line wins). Files are placed at their
+    usual paths as hardlinks to their blob, or copies where hardlinks are not supported. Urls are compared by
+    get_canonical_url. Blobs are never deleted."""
+
+    def __init__(self, path_dir: Path, logger: Optional[Logger] = None) -> None:
+        self.path_dir = path_dir
+        self.logger = logger
+        self.path_urls = path_dir / "urls.txt"
+        self.urls: dict[str, str] = {} # canonical url -> sha256
+        self._urls_file: Optional[TextIO] = None
+        self._lock = threading.Lock() # Blobs are written from worker threads
+        if self.path_urls.exists():
+            with open(self.path_urls, "r", encoding="utf-8") as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) == 2: # Else truncated by a crash
+                        self.urls[get_canonical_url(fields[0])] = fields[1]
+            if self.logger:
+                self.logger.debug(f"Loaded blob store urls from path={self.path_urls}: {len(self.urls)} urls.")
+        atexit.register(self.close)
+
+    def get_path(self, digest: str) -> Path:
+        return self.path_dir / digest[:2] / digest[2:4] / digest
+
+    def get_by_url(self, url: str) -> Optional[str]:
+        """sha256 of the blob downloaded from url, None if unknown or missing"""
+        digest = self.urls.get(get_canonical_url(url))
+        return digest if digest is not None and self.get_path(digest).exists() else None
+
+    def put(self, data: bytes, urls: Iterable[str] = ()) -> str:
+        """Store data unless already stored, remember it was downloaded from urls, and return its sha256"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.get_path(digest)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path_tmp = path.with_name(f"{digest}.{uuid4().hex}.tmp")
+            with open(path_tmp, "wb") as f:
+                f.write(data)
+            os.replace(path_tmp, path) # Whole blob or nothing
+        with self._lock:
+            new = [url for url in dict.fromkeys(map(get_canonical_url, urls)) if self.urls.get(url) != digest]
+            if new:
+                if self._urls_file is None:
+                    self.path_dir.mkdir(parents=True, exist_ok=True)
+                    self._urls_file = open(self.path_urls, "a", encoding="utf-8")
+                self._urls_file.write("".join(f"{url}\t{digest}\n" for url in new))
+                self._urls_file.flush()
+                self.urls.update(dict.fromkeys(new, digest))
+        return digest
+
+    def link(self, digest: str, dest: Path) -> None:
+        """Place blob digest at dest, replacing what is there"""
+        path = self.get_path(digest)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        if dest.exists() and os.path.samefile(path, dest):
+            return
+        dest_tmp = dest.with_name(f"{dest.name}.{uuid4().hex}.tmp")
+        try:
+            os.link(path, dest_tmp)
+        except OSError: # No hardlinks on this filesystem, or another drive
+            shutil.copyfile(path, dest_tmp)
+        os.replace(dest_tmp, dest)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._urls_file is not None:
+                self._urls_file.close()
+                self._urls_file = None
+
+class KahBlobManifest:
+    """Which blob of a KahBlobStore each file of an event is, one line per file at path_manifest: path relative to the
+    event output and sha256, tab separated. When a path was saved several times, the last line wins."""
+
+    def __init__(self, path_manifest: Path) -> None:
+        self.path_manifest = path_manifest
+        self.entries: dict[str, str] = {} # relative path -> sha256
+        self._file: Optional[TextIO] = None
+        self._lock = threading.Lock()
+        if path_manifest.exists():
+            with open(path_manifest, "r", encoding="utf-8") as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) == 2:
+                        self.entries[fields[0]] = fields[1]
+        atexit.register(self.close)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def add(self, rel_path: str, digest: str) -> None:
+        with self._lock:
+            if self.entries.get(rel_path) == digest:
+                return
+            if self._file is None:
+                self.path_manifest.parent.mkdir(parents=True, exist_ok=True)
+                self._file = open(self.path_manifest, "a", encoding="utf-8")
+            self._file.write(f"{rel_path}\t{digest}\n")
+            self._file.flush()
+            self.entries[rel_path] = digest
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
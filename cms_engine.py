@@ -0,0 +1,706 @@
+"""
+Multi-event crawler engine, crawls several events concurrently with one shared fetcher
+"""
+import os
+import time
+import asyncio
+import aiofiles
+import aiohttp
+import argparse
+import json
+import re
+import logging
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from aiohttp import ClientResponse
+from functools import partial
+from cms_skip import KahSkipManager, get_canonical_url
+from cms_archive import KahResponseArchive, KahQuarantine, KahBlobStore, KahBlobManifest
+from cms_frontier import KahFrontier
+from cms_fetch import KahCircuitBreaker, KahRetryQueue, KahOfflineFetcher, KahAimdLimiter, KahPoliteFetcher, KahSingleFlightFetcher, get_host
+from cms_parse import CircleRecord, parse_circle, parse_cutlist
+from cms_index import KahIndexBackend, KahFingerprintIndexBackend, KahMmapIndexBackend, KahSqliteIndexBackend
+from typing import Any, Callable, Literal, Optional, Sequence, TypeVar
+
+from db_structs import Circle, is_to_add, Medium, Source, ReliabilityTypes, OriginTypes
+from cms_lib import KahLogger, KahHostLimiter, KahHostPolicy, decode_if_possible, callback_image_save, redirect_url
+from kahscrape.kahscrape import KahRatelimitedFetcher, FetcherABC
+
+# ==================================================================
+#  General setup
+# ==================================================================
+
+PATH_CURRENT = Path(__file__).parent
+PATH_PROCESS = PATH_CURRENT / "process"
+HOST_ARCHIVES = "webcatalog-archives.circle.ms"
+URL_ARCHIVES = f"https://{HOST_ARCHIVES}"
+DAY_CANDIDATES: tuple[int, ...] = (99, 1, 2, 3, 4, 5, 6) # Probed, only existing days are crawled. 99 is the failed lottery
+
+IndexKind = Literal["text", "fingerprint", "mmap", "sqlite"]
+RateKind = Literal["fixed", "adaptive"]
+DEFAULT_HOST_POLICY = KahHostPolicy(concurrency=4, interval=0.25) # Image hosts
+ARCHIVES_HOST_POLICY = KahHostPolicy(concurrency=2, interval=0.25) # circle.ms, strict
+PRIORITY_CLASSES = ("cutlist", "circle", "image") # Highest first: discover pages, then metadata, then images
+FRONTIER_CLASSES = ("cutlist", "circle") # Images are fetched by their circle callback, not queued
+FRONTIER_MAX_IN_FLIGHT = {"cutlist": 8, "circle": 64} # Pages handed to the fetcher and not handled yet, per class
+PRIORITY_MIN_SHARES = {"circle": 0.25, "image": 0.1}
+T = TypeVar("T")
+
+# ==================================================================
+#  Utilities
+# ==================================================================
+
+def parse_events(spec: str) -> list[str]:
+    """Parse events spec such as 'c83-c87' or 'c83,c85' into a list of events"""
+    events = []
+    for part in spec.split(","):
+        part = part.strip().lower()
+        if not part:
+            continue
+        m = re.fullmatch(r"c(\d+)-c?(\d+)", part)
+        if m:
+            first, last = int(m.group(1)), int(m.group(2))
+            if first > last:
+                raise ValueError(f"Invalid event range {part!r}")
+            events.extend(f"c{i}" for i in range(first, last + 1))
+        elif re.fullmatch(r"c\d+", part):
+            events.append(part)
+        else:
+            raise ValueError(f"Invalid event {part!r}")
+    return list(dict.fromkeys(events)) # Dedupe, keep order
+
+def parse_days(spec: str) -> list[int]:
+    """Parse days like '99,1-4' """
+    days = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        if not first.isdigit() or (last and not last.isdigit()):
+            raise ValueError(f"Invalid day {part!r}")
+        days.extend(range(int(first), int(last or first) + 1))
+    return list(dict.fromkeys(days))
+
+def load_cookies(paths: list[Path]) -> dict[str, str]:
+    """Merge cookies from every existing cookies.json in paths"""
+    cookies = {}
+    for path in paths:
+        if path.exists():
+            with open(path, "r", encoding='utf-8') as f:
+                cookies.update(json.load(f))
+    return cookies
+
+def parse_host_policy(spec: str) -> tuple[str, KahHostPolicy]:
+    """Parse 'host=concurrency/interval', e.g. 'pbs.twimg.com=8/0.1'"""
+    host, _, policy = spec.partition("=")
+    concurrency, _, interval = policy.partition("/")
+    if not host or not concurrency:
+        raise argparse.ArgumentTypeError(f"Invalid host policy {spec!r}, expected host=concurrency/interval")
+    return host.lower(), KahHostPolicy(int(concurrency), float(interval or 0.0))
+
+def get_priority(url: str) -> str:
+    """Priority class of url"""
+    if url.startswith(URL_ARCHIVES):
+        if "/xmlcutlist/" in url:
+            return "cutlist"
+        if "/xml/" in url:
+            return "circle"
+    return "image"
+
+def get_host_limiter(rate: RateKind = "fixed", policies: Optional[dict[str, KahHostPolicy]] = None) -> KahHostLimiter:
+    """Politeness domains, circle.ms keeping its strict budget unless paced by the adaptive limiter"""
+    archives_policy = ARCHIVES_HOST_POLICY if rate == "fixed" else KahHostPolicy(concurrency=64) # Capped by KahAimdLimiter
+    return KahHostLimiter(DEFAULT_HOST_POLICY, {HOST_ARCHIVES: archives_policy, **(policies or {})},
+                          PRIORITY_CLASSES, PRIORITY_MIN_SHARES)
+
+async def get_fetcher(cookies: dict[str, str], logger: KahLogger, host_limiter: KahHostLimiter, rate: RateKind = "fixed",
+                      breaker: Optional[KahCircuitBreaker] = None) -> FetcherABC:
+    """Fetcher shared by all events: one connection pool, one politeness domain per host, one request per url in flight.
+
+    rate "fixed" paces circle.ms by its host policy, "adaptive" lets a KahAimdLimiter pace it."""
+    session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10.0))
+    session.cookie_jar.update_cookies(cookies) # Attach cookies
+
+    # Pacing is done per host by KahPoliteFetcher, so that image hosts do not wait behind circle.ms
+    fetcher = KahRatelimitedFetcher(session=session, logger=logger, cc_min_wait_time=0.0)
+    adaptive = KahAimdLimiter(classes=PRIORITY_CLASSES, min_shares=PRIORITY_MIN_SHARES, logger=logger) if rate == "adaptive" else None
+    polite = KahPoliteFetcher(fetcher, host_limiter, adaptive, adaptive_hosts=[HOST_ARCHIVES], get_priority=get_priority,
+                              breaker=breaker) # Outcomes recorded once per request, not per single-flight follower
+    return KahSingleFlightFetcher(polite, logger=logger) # Duplicates share a request without taking a host slot
+
+
+# ==================================================================
+#  Circle building (pure, may run in a worker process)
+# ==================================================================
+
+def get_image_jobs(record: CircleRecord, event: str, circle_id: str) -> tuple[list[tuple[str, str]], list[tuple[str, str]]]:
+    """(url, relative save path) of the cuts, and of the 新着画像 of a circle"""
+    cut_jobs = []
+    if record.cut:
+        cut_jobs.append((redirect_url(f"{URL_ARCHIVES}/{event}/imgthm/{record.cut}"), f"cut_images/{record.cut}"))
+    if record.cut_web:
+        cut_jobs.append((redirect_url(f"{URL_ARCHIVES}/{event}/imgthm/{record.cut_web}"), f"cut_web_images/{record.cut_web}"))
+    image_jobs = []
+    for i, image_tag in enumerate(record.images):
+        img_format = re.search(r"\.([^\.]*)$", image_tag["画像Url"]).group(1)
+        image_jobs.append((redirect_url(image_tag["画像Url"]), f"circle_images/{circle_id}_{i}.{img_format}"))
+    return cut_jobs, image_jobs
+
+def build_circle_json(record: CircleRecord, event: str, circle_id: str, is_downloaded: list[bool]) -> str:
+    """Circle json of a parsed circle page, is_downloaded telling for each image of get_image_jobs whether it was saved locally"""
+    circle_space = record.space
+    if circle_space == "抽選洩れ":
+        circle_space = "抽選洩れ (Failed lottery)"
+
+    curls = [url for url in record.websites + record.shops if url]
+    for circle_id_link in (record.twitter, record.pixiv, record.niconico):
+        if circle_id_link:
+            curls.append(circle_id_link)
+
+    circle_goods = record.goods + record.other_goods
+
+    comments_args = []
+    if is_to_add(record.tags):
+        comments_args.append(f"Tags: {', '.join(tag['名称'].strip() for tag in record.tags)}") # TODO: to parse
+    if is_to_add(record.genre):
+        comments_args.append(f"Genre: {record.genre}")
+    if is_to_add(record.promotional_videos):
+        comments_args.append(f"Promotional Video: {', '.join(record.promotional_videos)}")
+    if is_to_add(record.promotional_videos):
+        comments_args.append(f"Promotional Images: {', '.join(record.promotional_images)}")
+    if is_to_add(circle_goods):
+        comments_args.append(f"Goods: {', '.join(circle_goods)}") #TODO: to parse
+    if is_to_add(record.description):
+        comments_args.append(f"Description: {record.description}")
+    if is_to_add(record.email):
+        comments_args.append(f"Email: {record.email}")
+    if is_to_add(record.promotional_links):
+        comments_args.append(f"Promotional Links: {', '.join( '(Title:' + tag['サービス名'].strip() + ', URL:' + tag['リンク先Url'].strip() + ')' for tag in record.promotional_links)}")
+
+    detail_url = f"{URL_ARCHIVES}/{event}/view/detail.html?id={circle_id}"
+    cut_jobs, image_jobs = get_image_jobs(record, event, circle_id)
+
+    media: list[Medium] = []
+    for (_url, rel_path), is_local in zip(cut_jobs, is_downloaded[:len(cut_jobs)]):
+        if not is_local:
+            media.append(Medium(f"{_url}",
+                                [Source(detail_url, (ReliabilityTypes.Reliable, OriginTypes.Official))]
+                                , comments="Link is dead thus image not downloaded"))
+        else:
+            media.append(Medium(rel_path,
+                                [Source(detail_url, (ReliabilityTypes.Reliable, OriginTypes.Official))]))
+
+    for image_tag, (_url, rel_path), is_local in zip(record.images, image_jobs, is_downloaded[len(cut_jobs):]):
+        img_title = image_tag["タイトル"]
+        img_url = image_tag["画像Url"]
+        img_source_link = image_tag["リンク先Url"]
+        img_date = image_tag["投稿日時"]
+        sources = [Source(img_source_link, (ReliabilityTypes.Reliable, OriginTypes.Official)),
+                   Source(f"Event circle page: {detail_url}", (ReliabilityTypes.Reliable, OriginTypes.Official)),
+                   Source(f"Fetch url: {img_url}", (ReliabilityTypes.Reliable, OriginTypes.Official))]
+        if not is_local:
+            media.append(Medium(f"{_url}", sources,
+                                comments=f'Note: link is dead and thus image not downloaded\nDate: {img_date}, Title: {img_title}'))
+        else:
+            media.append(Medium(rel_path, sources,
+                                comments=f'Date: {img_date}, Title: {img_title}'))
+
+    if True: # ==== processing fields with media ====
+        pass
+        # TODO: verify fields such as 'Promotional Images:' have examples
+
+    circle = Circle(
+        aliases=[record.name] if record.name else [],
+        pen_names=record.pen_names if is_to_add(record.pen_names) else None,
+        position=circle_space if is_to_add(circle_space) else None,
+        links=curls if is_to_add(curls) else None,
+        media=media if is_to_add(media) else None,
+        comments="\n".join(comments_args) if is_to_add(comments_args) else None
+    )
+
+    return json.dumps(circle.get_json(), ensure_ascii=False, indent=4)
+
+
+# ==================================================================
+#  Pipelines
+# ==================================================================
+
+class SharedResources:
+    """Resources shared by the crawlers of all events"""
+
+    def __init__(self, breaker: KahCircuitBreaker, executor: Optional[Executor] = None, blobs: Optional[KahBlobStore] = None) -> None:
+        self.breaker = breaker
+        self.executor = executor # For parsing and building circles, None to run them on the event loop
+        self.blobs = blobs # Images of all events, None to save them to their paths only
+        self.image_flights: dict[str, asyncio.Future] = {} # Canonical image url -> done once fetched, saved and marked
+
+    async def run_cpu(self, func: Callable[..., T], *args: Any) -> T:
+        """Run CPU-bound func in the executor, so that the event loop keeps serving sockets"""
+        if self.executor is None:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+class EventCrawler:
+    """Crawl pipelines for a single event, with its own output folder, logger and skip index"""
+
+    def __init__(self, event: str, path_event: Path, shared: SharedResources, index: IndexKind = "text", archive: bool = True,
+                 retry: bool = True, skip_done: bool = True, frontier: str = "frontier") -> None:
+        self.event = event
+        self.path_event = path_event
+        self.path_output = path_event / "output"
+        self.logger = KahLogger(event, self.path_output / "logger.log", logging.DEBUG, logging.INFO)
+        path_index = self.path_output / "downloaded_index.txt"
+        self.skipper = KahSkipManager(path_index, logger=self.logger, backend=self.get_index_backend(index, path_index))
+        self.shared = shared
+        self.archive = KahResponseArchive(self.path_output / "archive", prefix=event, logger=self.logger) if archive else None
+        self.retry = KahRetryQueue(self.path_output / "retry_queue.json", logger=self.logger) if retry else None
+        self.days_found: list[int] = []
+        self.quarantine = KahQuarantine(self.path_output / "quarantine", logger=self.logger)
+        self.frontier = KahFrontier(self.path_output / frontier, FRONTIER_CLASSES, get_priority, logger=self.logger)
+        self.skip_done = skip_done # Do not queue circles already done again
+        self.manifest = KahBlobManifest(self.path_output / "blob_manifest.txt") if shared.blobs is not None else None
+
+    async def archive_response(self, resp: ClientResponse | None, data: bytes | None) -> None:
+        """Keep the raw response, so that it can be parsed again without fetching it"""
+        if self.archive is not None and resp is not None and data is not None: # Compressed and written off the event loop
+            await asyncio.to_thread(self.archive.add_response, resp, data)
+
+    def get_stored_page(self, url: str) -> Optional[Path]:
+        """Saved copy of a cutlist page, for offline runs"""
+        m = re.search(rf"/{re.escape(self.event)}/xmlcutlist/([^/]*\.xml)$", url)
+        return self.path_output / "catalog_pages" / m.group(1) if m else None
+
+    def is_circle_done(self, url: str) -> bool:
+        """Whether the circle at url was fetched and its json written, with no retry pending"""
+        if not self.skipper.is_downloaded(url) or (self.retry is not None and url in self.retry.entries):
+            return False
+        circle_id = re.search(r"/([^/]*)\.xml$", url)
+        return circle_id is not None and (self.path_output / "circle_jsons" / f"circle_{circle_id.group(1)}.json").exists()
+
+    def get_index_backend(self, index: IndexKind, path_index: Path) -> Optional[KahIndexBackend]:
+        """Skip index storage, None for the default text index"""
+        if index == "fingerprint":
+            return KahFingerprintIndexBackend(path_index, logger=self.logger)
+        if index == "mmap":
+            return KahMmapIndexBackend(path_index, logger=self.logger)
+        if index == "sqlite": # Shared by all events, one namespace per event
+            backend = KahSqliteIndexBackend(self.path_event.parent / "downloaded_index.sqlite", namespace=self.event, logger=self.logger)
+            if path_index.exists() and backend.is_empty(): # Carry over the text index of previous runs
+                backend.import_text_index(path_index)
+            return backend
+        return None
+
+    async def onerr(
+            self,
+            fetcher: FetcherABC,
+            url: str, e: Exception,
+            resp: ClientResponse | None = None,
+            data: bytes | None = None
+        ):
+        if resp is not None and resp.status >= 400: # Successful responses are archived by their callback
+            await self.archive_response(resp, data)
+        status = resp.status if resp is not None else getattr(e, "status", None)
+        if status == 404 and re.search(r"/xmlcutlist/day\d+page0001\.xml$", url): # Day probe
+            self.logger.info(f"No day at {url}, skipping it.")
+            return
+        self.logger.warning(f"Error occurred while fetching {url}\n\tdata={f'{decode_if_possible(data)[:40]}...' if data else None}:\n\t{e=}")
+        if KahRetryQueue.is_retryable(e, status):
+            self.retry_later(fetcher, url, e)
+
+    def get_callback(self, url: str) -> Optional[Callable]:
+        """Callback handling url, None if it is not a page of this event"""
+        prefix = f"{URL_ARCHIVES}/{self.event}/"
+        if not url.startswith(prefix):
+            return None
+        path = url[len(prefix):]
+        first_page = re.fullmatch(r"xmlcutlist/day(\d+)page0001\.xml", path)
+        if first_page is not None:
+            return partial(self.onreq_xmlcutlist_firstdaypage, day=int(first_page.group(1)))
+        if re.fullmatch(r"xmlcutlist/[^/]*\.xml", path):
+            return self.onreq_xmlcutlist
+        if re.fullmatch(r"xml/[^/]*\.xml", path):
+            return partial(self.onreq_xmlcircle, url=url)
+        return None
+
+    def retry_later(self, fetcher: FetcherABC, url: str, e: BaseException) -> None:
+        """Queue page url again after its backoff delay"""
+        callback = self.get_callback(url)
+        if self.retry is None or callback is None: # Images are retried through their circle page
+            return
+        delay = self.retry.record_failure(url, e)
+        if delay is None:
+            return
+        self.logger.info(f"Retrying {url} in {delay:.1f}s.")
+        self.frontier.put_later(url, delay) # Not holding an in-flight slot meanwhile
+
+    def retry_done(self, url: str) -> None:
+        if self.retry is not None:
+            self.retry.record_success(url)
+
+    async def fetch_image(self, fetcher: FetcherABC, circle_id: str, _url: str, rel_path: str,
+                          failures: Optional[list[BaseException]] = None) -> bool:
+        """Fetch image at _url to output/rel_path unless skipped, return whether it is available locally.
+
+        Failures worth retrying are appended to failures. While another circle, of any event, fetches the same image,
+        wait until it saved and marked it, so that it is skipped or reused instead of fetched again."""
+        key = get_canonical_url(_url)
+        while key in self.shared.image_flights:
+            await asyncio.shield(self.shared.image_flights[key])
+        flight = asyncio.get_running_loop().create_future()
+        self.shared.image_flights[key] = flight
+        try:
+            return await self.fetch_image_once(fetcher, circle_id, _url, rel_path, failures)
+        finally:
+            del self.shared.image_flights[key]
+            flight.set_result(None)
+
+    async def fetch_image_once(self, fetcher: FetcherABC, circle_id: str, _url: str, rel_path: str,
+                               failures: Optional[list[BaseException]] = None) -> bool:
+        out_path = self.path_output / rel_path
+        ret = self.skipper.should_skip_url(_url) # Skip if already downloaded
+        if ret is not None:
+            if not out_path.exists() and self.skipper.is_downloaded(_url) \
+                    and await self.reuse_image(_url, rel_path): # Downloaded for another circle of this event
+                return True
+            self.logger.info(f"Skipping fetching {_url}: {ret}")
+            return out_path.exists()
+        if await self.reuse_image(_url, rel_path): # Downloaded for another circle or event
+            return True
+        if not self.shared.breaker.allow(_url, probe=False): # Host known dead, add as external medium
+            self.logger.info(f"Skipping fetching {_url}: circuit breaker open for host {get_host(_url)}.")
+            return False
+
+        async def onerr(fetcher: FetcherABC, url: str, e: Exception, resp: ClientResponse | None = None, data: bytes | None = None):
+            if failures is not None and KahRetryQueue.is_retryable(e, resp.status if resp is not None else None) \
+                    and not self.shared.breaker.is_open(url): # Retrying the circle would skip a dead host anyway
+                failures.append(e)
+            await self.onerr(fetcher, url, e, resp, data)
+
+        out = await fetcher.fetch_now(
+            _url,
+            onerr
+        )
+        if out is None: # Failed or short-circuited, add as external medium
+            self.logger.warning(f"Failed to fetch image {_url} for circle {circle_id=}, skipping saving it.")
+            return False
+        resp_buffer, data = out # Got image, manually run callback because fetch_now was used
+        await self.archive_response(resp_buffer, data)
+        await self.save_image(fetcher, resp_buffer, data, _url, rel_path)
+        self.skipper.mark_url_as_downloaded(_url, aliases=[str(resp_buffer.url)]) # Final url too, if redirected
+        return True
+
+    async def save_image(self, fetcher: FetcherABC, resp: ClientResponse, data: bytes, _url: str, rel_path: str) -> None:
+        """Save a fetched image to output/rel_path, through the blob store if any"""
+        out_path = self.path_output / rel_path
+        if self.shared.blobs is None:
+            await callback_image_save(fetcher, resp, data, save_file_path=out_path, logger=self.logger)
+            return
+        self.logger.info(f"Successfully fetched image {resp.url} ({len(data)} bytes)")
+        digest = await asyncio.to_thread(self.store_blob, data, [_url, str(resp.url)], rel_path)
+        self.logger.debug(f"Saved image to {out_path} (blob {digest})")
+
+    def store_blob(self, data: bytes, urls: list[str], rel_path: str) -> str:
+        digest = self.shared.blobs.put(data, urls)
+        self.link_blob(digest, rel_path)
+        return digest
+
+    def link_blob(self, digest: str, rel_path: str) -> None:
+        self.shared.blobs.link(digest, self.path_output / rel_path)
+        self.manifest.add(rel_path, digest)
+
+    async def reuse_image(self, _url: str, rel_path: str) -> bool:
+        """Place the stored image downloaded from _url at output/rel_path if there is one, return whether there was"""
+        if self.shared.blobs is None:
+            return False
+        digest = self.shared.blobs.get_by_url(_url)
+        if digest is None:
+            return False
+        await asyncio.to_thread(self.link_blob, digest, rel_path)
+        self.logger.info(f"Reusing stored image of {_url} (blob {digest}), not fetching it.")
+        self.skipper.mark_url_as_downloaded(_url)
+        return True
+
+    # //////////////////////////////////////////////////////////////
+    #  Circle info page (XML)
+    # //////////////////////////////////////////////////////////////
+    async def onreq_xmlcircle(self, fetcher: FetcherABC, resp: ClientResponse, data: bytes, url: Optional[str] = None):
+        """For circle xml pages, url being the requested url when resp may have been redirected"""
+        url = url if url is not None else str(resp.url)
+        self.logger.info(f"Successfully fetched {resp.url}:\n\t{data[:100].replace(b'\n', b'')}...")
+        self.skipper.mark_url_as_downloaded(str(resp.url))
+        await self.archive_response(resp, data)
+
+        circle_id = re.search(r"/([^/]*)\.xml$", url)
+        if circle_id is None:
+            await self.onerr(fetcher, url, Exception("Invalid URL format"), resp, data)
+            return
+        circle_id = circle_id.group(1)
+
+        record = await self.shared.run_cpu(parse_circle, data)
+        if record is None:
+            await self.onerr(fetcher, str(resp.url), Exception("No Circle found, invalid circle xml!"), resp, data)
+            return
+        if record.name is None:
+            await self.onerr(fetcher, str(resp.url), Exception("No Circle name found, invalid circle xml!"), resp, data)
+            return
+        cut_jobs, image_jobs = get_image_jobs(record, self.event, circle_id)
+        failures: list[BaseException] = []
+        is_downloaded = await asyncio.gather(*(
+            self.fetch_image(fetcher, circle_id, _url, rel_path, failures) for _url, rel_path in cut_jobs + image_jobs
+        ))
+
+        if record.unknown_tags: # At least one field not supported, keep the circle aside and emit what is supported
+            self.quarantine.add(circle_id, str(resp.url), data, record.unknown_tags)
+
+        circle_json = await self.shared.run_cpu(build_circle_json, record, self.event, circle_id, is_downloaded)
+        out_path = self.path_output / "circle_jsons" / f"circle_{circle_id}.json"
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        async with aiofiles.open(out_path, "w+", encoding='utf-8') as f:
+            await f.write(circle_json)
+
+        if failures: # Fetch the circle again later for its missing images
+            self.retry_later(fetcher, url, failures[0]) # Keyed by the requested url, as track clears it
+
+
+    # //////////////////////////////////////////////////////////////
+    #  Cut list pages (XML)
+    # //////////////////////////////////////////////////////////////
+    async def onreq_xmlcutlist(self, fetcher: FetcherABC, resp: ClientResponse, data: bytes):
+        """For cutlist xml pages"""
+        self.logger.info(f"Successfully fetched {resp.url}:\n\t{decode_if_possible(data)[:40]}...")
+        self.skipper.mark_url_as_downloaded(str(resp.url))
+        await self.archive_response(resp, data)
+
+        _, circle_ids = await self.shared.run_cpu(parse_cutlist, data)
+        await self.process_cutlist(fetcher, resp, data, circle_ids)
+
+    async def process_cutlist(self, fetcher: FetcherABC, resp: ClientResponse, data: bytes, circle_ids: list[str]):
+        """Queue circles of an already parsed cutlist page and save it"""
+        day_page = re.search(r"/([^/]*)\.xml$", str(resp.url))
+        if day_page is None:
+            await self.onerr(fetcher, str(resp.url), Exception("Invalid URL format"), resp, data)
+            return
+        day_page = day_page.group(1)
+        self.logger.debug(f"Found {len(circle_ids)} circles in {resp.url}")
+
+        circle_xml_urls = [f"{URL_ARCHIVES}/{self.event}/xml/{cid}.xml" for cid in circle_ids]
+        skip = self.is_circle_done if self.skip_done else None
+        added = await self.frontier.put_many(circle_xml_urls, skip=skip)
+        if added < len(circle_xml_urls):
+            self.logger.debug(f"Skipped {len(circle_xml_urls) - added} circles of {resp.url} already queued or done.")
+
+        out_path = self.path_output / "catalog_pages" / f"{day_page}.xml"
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        async with aiofiles.open(out_path, "wb+") as f:
+            await f.write(data)
+
+    async def onreq_xmlcutlist_firstdaypage(self, fetcher: FetcherABC, resp: ClientResponse, data: bytes, day: int = 0):
+        """First page for the day"""
+        self.logger.info(f"Successfully fetched {resp.url}:\n\t{decode_if_possible(data)[:40]}...")
+        self.skipper.mark_url_as_downloaded(str(resp.url))
+        await self.archive_response(resp, data)
+
+        # Get total number of pages and circles of the first page in one pass
+        last_page, circle_ids = await self.shared.run_cpu(parse_cutlist, data)
+        if last_page is None: # Probed day that does not exist
+            self.logger.info(f"No 全ページ数 found in {resp.url}, skipping day {day}.")
+            return
+        self.days_found.append(day)
+        self.logger.info(f"Found day {day} with {last_page} pages.")
+
+        # Run pipeline for first page
+        await self.process_cutlist(fetcher, resp, data, circle_ids)
+
+        # Queue other pages
+        xmlcutlist_urls = (
+            f"{URL_ARCHIVES}/{self.event}/xmlcutlist/day{day}page{i:04d}.xml"
+            for i in range(2, last_page + 1)
+        )
+        await self.frontier.put_many(xmlcutlist_urls)
+
+    # //////////////////////////////////////////////////////////////
+    #  Frontier
+    # //////////////////////////////////////////////////////////////
+    def track(self, url: str, callback: Callable, release: Optional[Callable[[], None]] = None) -> tuple[Callable, Callable]:
+        """Callback and onerr for a frontier url, marking it handled, and calling release, once either one returns"""
+        done = False
+
+        def task_done():
+            nonlocal done
+            if not done:
+                done = True
+                self.frontier.task_done(url)
+                if release is not None:
+                    release()
+
+        async def run(handler: Callable, *args):
+            try:
+                await handler(*args)
+            except asyncio.CancelledError: # Interrupted, left in the frontier journal to be resumed
+                raise
+            except BaseException:
+                task_done()
+                raise
+            task_done()
+
+        async def _callback(fetcher: FetcherABC, resp: ClientResponse, data: bytes):
+            if self.skipper.get_key(str(resp.url)) != self.skipper.get_key(url): # Redirected, callbacks mark the final url
+                self.skipper.mark_url_as_downloaded(url)
+            failed = self.retry.entries.get(url) if self.retry is not None else None
+            await run(callback, fetcher, resp, data)
+            if self.retry is not None and self.retry.entries.get(url) is failed: # No new failure recorded by callback
+                self.retry_done(url)
+
+        async def _onerr(fetcher: FetcherABC, url: str, e: Exception, resp: ClientResponse | None = None, data: bytes | None = None):
+            await run(self.onerr, fetcher, url, e, resp, data)
+        return _callback, _onerr
+
+    async def consume(self, fetcher: FetcherABC, cls: str) -> None:
+        """Hand the urls of a frontier class to the fetcher, at most FRONTIER_MAX_IN_FLIGHT of them not handled yet so
+        that slow callbacks hold back the class instead of piling up"""
+        in_flight = asyncio.Semaphore(FRONTIER_MAX_IN_FLIGHT[cls])
+        while True:
+            await in_flight.acquire()
+            url = await self.frontier.get(cls)
+            callback = self.get_callback(url)
+            if callback is None:
+                self.logger.warning(f"No callback for {url}, dropping it.")
+                self.frontier.task_done(url)
+                in_flight.release()
+                continue
+            await fetcher.fetch(url, *self.track(url, callback, in_flight.release))
+
+    async def start(self, fetcher: FetcherABC, retry_only: bool = False, days: Sequence[int] = DAY_CANDIDATES) -> None:
+        """Crawl the event: first cutlist page of every candidate day at once, then the pages of the retry queue
+        once they are due, and everything they lead to until the frontier is empty. Days without cutlist are skipped.
+
+        If a previous run was interrupted, its frontier is resumed instead of starting over from the first pages."""
+        consumers = [asyncio.create_task(self.consume(fetcher, cls)) for cls in FRONTIER_CLASSES]
+        try:
+            resumed = await self.frontier.resume()
+            if not retry_only and not resumed:
+                for day in days:
+                    await self.frontier.put(f"{URL_ARCHIVES}/{self.event}/xmlcutlist/day{day}page0001.xml")
+            if self.retry is not None:
+                resumed_urls = set(resumed)
+                due = [(url, delay) for url, delay in self.retry.get_due() if url not in resumed_urls]
+                self.logger.info(f"{len(due)} urls in retry queue.")
+                started = time.monotonic()
+                for url, delay in due:
+                    if self.get_callback(url) is None:
+                        continue
+                    await asyncio.sleep(max(0.0, delay - (time.monotonic() - started)))
+                    await self.frontier.put(url)
+            await self.frontier.join()
+            self.frontier.finish()
+            if self.days_found:
+                self.logger.info(f"Crawled days {sorted(self.days_found)}.")
+        finally:
+            for consumer in consumers:
+                consumer.cancel()
+            self.frontier.close()
+
+
+# ==================================================================
+#  Main
+# ==================================================================
+
+def get_frontier_name(offline: bool, retry_only: bool) -> str:
+    """Frontier folder of a run, offline and retry-only runs keeping their own so that they neither resume nor drop
+    the checkpoint of an interrupted crawl"""
+    if offline:
+        return "frontier_offline"
+    return "frontier_retry" if retry_only else "frontier"
+
+def get_executor(parse_pool: Literal["process", "thread", "none"], parse_workers: Optional[int]) -> Optional[Executor]:
+    """Executor for parsing and building circles, parse_workers None for one per core"""
+    if parse_pool == "process":
+        return ProcessPoolExecutor(max_workers=parse_workers)
+    if parse_pool == "thread":
+        return ThreadPoolExecutor(max_workers=parse_workers or os.cpu_count())
+    return None
+
+async def crawl_events(events: list[str], path_process: Path = PATH_PROCESS, path_cookies: Optional[Path] = None,
+                       index: IndexKind = "text",
+                       parse_pool: Literal["process", "thread", "none"] = "process", parse_workers: Optional[int] = None,
+                       archive: bool = True, offline: bool = False, rate: RateKind = "fixed",
+                       host_policies: Optional[dict[str, KahHostPolicy]] = None, retry_only: bool = False,
+                       days: Sequence[int] = DAY_CANDIDATES, blobs: bool = True) -> None:
+    """Crawl all given events concurrently, each event writing to path_process/{event}/output.
+
+    With blobs, images are stored once in path_process/blobs and linked to their path in each event. With offline,
+    circle jsons are rebuilt from the archived responses and saved cutlist pages only. With retry_only, only the pages
+    left in the retry queues of the events, and what they lead to, are fetched. Both keep a frontier of their own
+    (see get_frontier_name)."""
+    logger = KahLogger("cms", path_process / "logger.log", logging.DEBUG, logging.INFO)
+    # Offline misses are not host failures, keep the saved breaker state out of it
+    path_breaker = None if offline else path_process / "circuit_breaker.json"
+    breaker = KahCircuitBreaker(path_breaker, exempt_hosts=[HOST_ARCHIVES], logger=logger)
+    executor = get_executor(parse_pool, parse_workers)
+    blob_store = KahBlobStore(path_process / "blobs", logger=logger) if blobs else None
+    shared = SharedResources(breaker, executor, blob_store)
+    crawlers = [EventCrawler(event, path_process / event, shared, index, archive and not offline, retry=not offline,
+                             skip_done=not offline, frontier=get_frontier_name(offline, retry_only)) for event in events]
+
+    if offline:
+        archives = [KahResponseArchive(crawler.path_output / "archive", prefix=crawler.event, logger=crawler.logger) for crawler in crawlers]
+        fetcher = KahOfflineFetcher(archives, [crawler.get_stored_page for crawler in crawlers], logger=logger)
+        logger.info(f"Replaying stored responses of events {events}.")
+    else:
+        cookies = load_cookies([path_cookies] if path_cookies else [crawler.path_event / "cookies.json" for crawler in crawlers])
+        logger.info(f"Crawling events {events} with {len(cookies)} cookies.")
+        fetcher = await get_fetcher(cookies, logger, get_host_limiter(rate, host_policies), rate, breaker)
+    await asyncio.gather(*(crawler.start(fetcher, retry_only, days) for crawler in crawlers))
+    await fetcher.wait_and_close()
+    for crawler in crawlers: # Flush skip journals and archives
+        crawler.skipper.close()
+        if crawler.archive is not None:
+            crawler.archive.close()
+        if crawler.manifest is not None:
+            crawler.manifest.close()
+        if crawler.retry is not None:
+            crawler.retry.save()
+            if len(crawler.retry):
+                crawler.logger.warning(f"{len(crawler.retry)} urls left in retry queue, run again with --retry-only.")
+        if crawler.quarantine.counts:
+            crawler.logger.warning(f"Unsupported fields, circles in {crawler.quarantine.path_dir}: {crawler.quarantine.get_summary()}")
+    breaker.save()
+    if blob_store is not None:
+        blob_store.close()
+    if executor is not None:
+        executor.shutdown()
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Scrape the comiket web catalog archives for several events at once.")
+    parser.add_argument("--events", required=True, help="Events to crawl, e.g. 'c83-c87' or 'c83,c85'")
+    parser.add_argument("--path-process", type=Path, default=PATH_PROCESS, help="Folder holding one subfolder per event")
+    parser.add_argument("--cookies", type=Path, default=None, help="cookies.json to use instead of each event's cookies.json")
+    parser.add_argument("--index", choices=("text", "fingerprint", "mmap", "sqlite"), default="text",
+                        help="Skip index storage: text file per event, same with 64-bit fingerprints in memory, "
+                             "memory-mapped sorted file per event, or one shared SQLite database")
+    parser.add_argument("--parse-pool", choices=("process", "thread", "none"), default="process",
+                        help="Where xml parsing and circle building run: process pool, thread pool, or on the event loop")
+    parser.add_argument("--parse-workers", type=int, default=None, help="Parse pool size, defaults to the number of cores")
+    parser.add_argument("--no-archive", dest="archive", action="store_false",
+                        help="Do not keep raw responses in each event's output/archive")
+    parser.add_argument("--no-blob-store", dest="blobs", action="store_false",
+                        help="Save images to each event's output only, instead of once in path-process/blobs linked from each event")
+    parser.add_argument("--rate", choices=("fixed", "adaptive"), default="fixed",
+                        help="Request pacing: fixed 0.25s between requests, or adaptive to circle.ms responses and latency")
+    parser.add_argument("--host-policy", type=parse_host_policy, action="append", default=[],
+                        help="Concurrency and seconds between requests for a host, e.g. 'pbs.twimg.com=8/0.1', repeatable")
+    parser.add_argument("--days", type=parse_days, default=list(DAY_CANDIDATES),
+                        help="Days to probe, e.g. '99,1-4', days that do not exist are skipped")
+    parser.add_argument("--retry-only", action="store_true",
+                        help="Only fetch the pages left in each event's retry queue by previous runs")
+    parser.add_argument("--offline", action="store_true",
+                        help="Rebuild circle jsons from archived responses and saved cutlist pages, without network")
+    args = parser.parse_args(argv)
+
+    asyncio.run(crawl_events(parse_events(args.events), args.path_process, args.cookies, args.index,
+                             args.parse_pool, args.parse_workers, args.archive, args.offline, args.rate,
+                             dict(args.host_policy), args.retry_only, args.days, args.blobs))
+
+if __name__ == '__main__':
+    main()
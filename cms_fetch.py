@@ -0,0 +1,571 @@
+"""
+Fetch layer utilities
+"""
+import os
+import json
+import time
+import math
+import random
+import atexit
+import asyncio
+import aiohttp
+from yarl import URL
+from pathlib import Path
+from logging import Logger
+from typing import Any, Awaitable, Callable, Iterable, NamedTuple, Optional, Sequence
+from urllib.parse import urlsplit
+from email.utils import parsedate_to_datetime
+from cms_archive import KahResponseArchive
+from cms_lib import KahHostLimiter, KahPriorityGate
+from cms_skip import get_canonical_url
+from kahscrape.kahscrape import FetcherABC
+
+def get_host(url: str) -> str:
+    """Lowercase host of url, empty if none"""
+    return (urlsplit(url).hostname or "").lower()
+
+class KahCircuitBreaker:
+    """Per-host circuit breaker, stops requesting hosts that keep failing to connect.
+
+    After max_failures consecutive connection, DNS or timeout failures the circuit of a host opens and its requests
+    are short-circuited. Once cooldown seconds passed, one probe request is let through: success closes the circuit,
+    failure opens it again. State is saved to path_state (json) and reloaded on next run."""
+
+    def __init__(self,
+                 path_state: Optional[Path] = None,
+                 max_failures: int = 3,
+                 cooldown: float = 6 * 3600.0,
+                 exempt_hosts: Iterable[str] = (),
+                 save_at_exit: bool = True,
+                 logger: Optional[Logger] = None) -> None:
+        self.path_state = path_state
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.exempt_hosts = {host.lower() for host in exempt_hosts}
+        self.logger = logger
+        self.failures: dict[str, int] = {} # host -> consecutive failures
+        self.opened_at: dict[str, float] = {} # host -> time the circuit opened
+        self.probing: set[str] = set()
+
+        if self.path_state is not None and self.path_state.exists():
+            with open(self.path_state, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            self.failures = state.get("failures", {})
+            self.opened_at = state.get("opened_at", {})
+            if self.logger:
+                self.logger.debug(f"Loaded circuit breaker state from path={self.path_state}: {len(self.opened_at)} open hosts.")
+        if save_at_exit and self.path_state is not None:
+            atexit.register(self.save)
+
+    @staticmethod
+    def is_connection_failure(e: BaseException) -> bool:
+        """Whether e means the host could not be reached, as opposed to an HTTP error status"""
+        return isinstance(e, (aiohttp.ClientConnectionError, asyncio.TimeoutError, OSError))
+
+    def allow(self, url: str, probe: bool = True) -> bool:
+        """Whether url may be requested now. Without probe, only tell whether it could be, letting no probe through"""
+        host = get_host(url)
+        opened_at = self.opened_at.get(host)
+        if opened_at is None or host in self.exempt_hosts:
+            return True
+        if time.time() - opened_at < self.cooldown or host in self.probing:
+            return False
+        if not probe:
+            return True
+        self.probing.add(host) # Half-open, let this one through
+        if self.logger:
+            self.logger.info(f"Probing host {host} after circuit breaker cooldown.")
+        return True
+
+    def is_open(self, url: str) -> bool:
+        """Whether the circuit of url's host is open, without letting a probe through"""
+        return get_host(url) in self.opened_at and get_host(url) not in self.exempt_hosts
+
+    def record_success(self, url: str) -> None:
+        host = get_host(url)
+        self.probing.discard(host)
+        self.failures.pop(host, None)
+        if self.opened_at.pop(host, None) is not None and self.logger:
+            self.logger.info(f"Closing circuit breaker for host {host}.")
+
+    def record_failure(self, url: str, e: BaseException) -> None:
+        host = get_host(url)
+        if host in self.exempt_hosts:
+            return
+        if not self.is_connection_failure(e): # Host answered
+            self.record_success(url)
+            return
+        if host in self.opened_at and host not in self.probing: # Sent before the circuit opened
+            return
+        self.failures[host] = self.failures.get(host, 0) + 1
+        if host in self.probing or self.failures[host] >= self.max_failures:
+            self.probing.discard(host)
+            self.opened_at[host] = time.time()
+            if self.logger:
+                self.logger.warning(f"Opening circuit breaker for host {host} after {self.failures[host]} consecutive failures.")
+
+    def save(self) -> None:
+        """Save state to path_state"""
+        if self.path_state is None:
+            return
+        self.path_state.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path_state, "w", encoding="utf-8") as f:
+            json.dump({"failures": self.failures, "opened_at": self.opened_at}, f, indent=4)
+
+class KahCircuitOpen(Exception):
+    """Request short-circuited, the circuit of its host is open"""
+
+class KahRetryEntry(NamedTuple):
+    """A failed url waiting to be fetched again"""
+    attempts: int
+    last_error: str
+    next_time: float # time.time() from which it may be retried
+
+class KahRetryQueue:
+    """Persistent queue of failed requests, retried with exponential backoff and jitter.
+
+    The n-th consecutive failure of an url delays its next attempt by a random time between half and all of
+    base_delay * 2 ** (n - 1), capped at max_delay. After max_attempts failures in a run the url is given up for the
+    run but kept in the queue, so that the next run or a retry-only run tries it again. State is saved to path_state
+    (json) at most every save_interval seconds while it changes, and at exit."""
+
+    def __init__(self,
+                 path_state: Optional[Path] = None,
+                 max_attempts: int = 5,
+                 base_delay: float = 2.0,
+                 max_delay: float = 300.0,
+                 save_interval: float = 5.0,
+                 save_at_exit: bool = True,
+                 logger: Optional[Logger] = None) -> None:
+        self.path_state = path_state
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.save_interval = save_interval
+        self.logger = logger
+        self.entries: dict[str, KahRetryEntry] = {}
+        self.run_attempts: dict[str, int] = {} # url -> failures in this run
+        self._saved_at = float("-inf") # First change saved right away
+
+        if self.path_state is not None and self.path_state.exists():
+            with open(self.path_state, "r", encoding="utf-8") as f:
+                self.entries = {url: KahRetryEntry(*entry) for url, entry in json.load(f).items()}
+            if self.logger:
+                self.logger.debug(f"Loaded retry queue from path={self.path_state}: {len(self.entries)} urls.")
+        if save_at_exit and self.path_state is not None:
+            atexit.register(self.save)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @staticmethod
+    def is_retryable(e: BaseException, status: Optional[int] = None) -> bool:
+        """Whether the failure may go away by itself: connection failure, timeout, 429 or 5xx"""
+        status = status if status is not None else getattr(e, "status", None)
+        if status is not None:
+            return status == 429 or status >= 500
+        return KahCircuitBreaker.is_connection_failure(e)
+
+    def get_delay(self, attempts: int) -> float:
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return random.uniform(delay / 2, delay)
+
+    def record_failure(self, url: str, e: BaseException) -> Optional[float]:
+        """Record a failed attempt at url, return the delay before retrying it, None if given up for this run"""
+        previous = self.entries.get(url)
+        attempts = previous.attempts + 1 if previous is not None else 1
+        run_attempts = self.run_attempts[url] = self.run_attempts.get(url, 0) + 1
+        delay = self.get_delay(min(attempts, self.max_attempts))
+        self.entries[url] = KahRetryEntry(attempts, f"{type(e).__name__}: {e}", time.time() + delay)
+        self._changed()
+        if run_attempts >= self.max_attempts:
+            if self.logger:
+                self.logger.warning(f"Giving up on {url} for this run after {attempts} attempts, kept in retry queue.")
+            return None
+        return delay
+
+    def record_success(self, url: str) -> None:
+        self.run_attempts.pop(url, None)
+        if self.entries.pop(url, None) is not None:
+            self._changed()
+
+    def _changed(self) -> None:
+        if time.monotonic() - self._saved_at >= self.save_interval:
+            self.save()
+
+    def get_due(self) -> list[tuple[str, float]]:
+        """Queued urls with their seconds left before they may be retried, soonest first"""
+        now = time.time()
+        return sorted(((url, max(0.0, entry.next_time - now)) for url, entry in self.entries.items()), key=lambda x: x[1])
+
+    def save(self) -> None:
+        """Save state to path_state"""
+        if self.path_state is None:
+            return
+        self.path_state.parent.mkdir(parents=True, exist_ok=True)
+        path_tmp = self.path_state.with_suffix(".tmp") # Replaced only once complete
+        with open(path_tmp, "w", encoding="utf-8") as f:
+            json.dump({url: list(entry) for url, entry in self.entries.items()}, f, indent=4, ensure_ascii=False)
+        os.replace(path_tmp, self.path_state)
+        self._saved_at = time.monotonic()
+
+class KahOfflineMiss(Exception):
+    """Url has no stored response"""
+
+class KahOfflineResponse:
+    """Stored response, with the ClientResponse attributes the callbacks use"""
+    def __init__(self, url: str, status: int = 200, reason: str = "OK", headers: Optional[list[tuple[str, str]]] = None) -> None:
+        self.url = URL(url)
+        self.status = status
+        self.reason = reason
+        self.headers = dict(headers or [])
+
+class KahOfflineFetcher(FetcherABC):
+    """Stand-in fetcher serving stored responses, no network and no rate limit.
+
+    Responses are looked up in archives, then through fallbacks (functions returning the path of a stored file for
+    an url, or None). Callbacks of fetch run concurrently, at most max_concurrency at a time. Urls with no stored
+    response, or stored with an error status, go to onerr."""
+
+    def __init__(self,
+                 archives: Iterable[KahResponseArchive] = (),
+                 fallbacks: Iterable[Callable[[str], Optional[Path]]] = (),
+                 max_concurrency: int = 64,
+                 logger: Optional[Logger] = None) -> None:
+        self.archives = list(archives)
+        self.fallbacks = list(fallbacks)
+        self.logger = logger
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.tasks: set[asyncio.Task] = set()
+
+    def get(self, url: str) -> tuple[KahOfflineResponse, bytes]:
+        """Stored response for url, raise KahOfflineMiss if there is none"""
+        for archive in self.archives:
+            stored = archive.get(url)
+            if stored is not None:
+                return KahOfflineResponse(url, stored.status, stored.reason, stored.headers), stored.data
+        for fallback in self.fallbacks:
+            path = fallback(url)
+            if path is not None and path.exists():
+                return KahOfflineResponse(url), path.read_bytes()
+        raise KahOfflineMiss(f"No stored response for {url}")
+
+    async def fetch_now(self, url: str, onerr: Callable[..., Awaitable]) -> Optional[tuple[KahOfflineResponse, bytes]]:
+        try:
+            resp, data = self.get(url)
+        except KahOfflineMiss as e:
+            await onerr(self, url, e, None, None)
+            return None
+        if resp.status >= 400:
+            await onerr(self, url, Exception(f"Stored response has status {resp.status} {resp.reason}"), resp, data)
+            return None
+        return resp, data
+
+    async def _run(self, url: str, callback: Callable[..., Awaitable], onerr: Callable[..., Awaitable]) -> None:
+        async with self.semaphore:
+            out = await self.fetch_now(url, onerr)
+            if out is not None:
+                await callback(self, *out)
+
+    async def fetch(self, url: str, callback: Callable[..., Awaitable], onerr: Callable[..., Awaitable]) -> None:
+        task = asyncio.create_task(self._run(url, callback, onerr))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def wait_and_close(self) -> None:
+        """Wait for all queued urls, including the ones queued by callbacks"""
+        while self.tasks:
+            await asyncio.gather(*self.tasks)
+        if self.logger:
+            self.logger.info("Done replaying stored responses.")
+
+
+class KahAimdLimiter:
+    """Adaptive concurrency limit (additive increase, multiplicative decrease), like TCP congestion control.
+
+    Each success raises the limit by increase / limit, that is by increase per window of requests. A 429, a 5xx or
+    a latency above latency_factor times its moving average cuts the limit by decrease, at most once per average
+    latency so that one burst of errors counts once. Retry-After pauses all new requests. The current rate is logged
+    every report_interval seconds."""
+
+    def __init__(self,
+                 initial_limit: float = 2.0,
+                 min_limit: float = 1.0,
+                 max_limit: float = 16.0,
+                 increase: float = 1.0,
+                 decrease: float = 0.5,
+                 latency_factor: float = 3.0,
+                 report_interval: float = 30.0,
+                 classes: Sequence[str] = ("default",),
+                 min_shares: Optional[dict[str, float]] = None,
+                 logger: Optional[Logger] = None) -> None:
+        self.limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.report_interval = report_interval
+        self.logger = logger
+        self.gate = KahPriorityGate(math.floor(initial_limit), classes, min_shares) # Waiting requests by priority
+        self.latency: Optional[float] = None # Moving average of successful requests
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.done = 0 # Since last report
+        self.last_report = time.monotonic()
+
+    async def acquire(self, priority: Optional[str] = None) -> float:
+        """Wait for a slot, return the start time to give back to release"""
+        await self.gate.acquire(priority)
+        try:
+            while (pause := self.paused_until - time.monotonic()) > 0:
+                await asyncio.sleep(pause)
+        except BaseException:
+            self.gate.release()
+            raise
+        return time.monotonic()
+
+    @staticmethod
+    def parse_retry_after(value: Optional[str]) -> Optional[float]:
+        """Seconds to wait from a Retry-After header, either seconds or an HTTP date"""
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    async def release(self, started: float, status: Optional[int] = None, retry_after: Optional[str] = None) -> None:
+        """Give back the slot taken at started, with the HTTP status of the response (None if there was none)"""
+        now = time.monotonic()
+        elapsed = now - started
+        overloaded = status is not None and (status == 429 or status >= 500)
+        slow = self.latency is not None and elapsed > self.latency_factor * self.latency
+        if overloaded or slow:
+            if now - self.last_decrease > (self.latency or 0.0):
+                self.last_decrease = now
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+                if self.logger:
+                    reason = f"status {status}" if overloaded else f"latency {elapsed:.2f}s"
+                    self.logger.info(f"Rate limiter: {reason}, limit lowered to {self.limit:.1f} concurrent requests.")
+            pause = self.parse_retry_after(retry_after)
+            if pause is not None:
+                was_paused = self.paused_until > now
+                self.paused_until = max(self.paused_until, now + pause)
+                if self.logger and not was_paused:
+                    self.logger.warning(f"Rate limiter: pausing requests for {pause:.1f}s (Retry-After).")
+        elif status is not None and status < 400:
+            self.limit = min(self.max_limit, self.limit + self.increase / self.limit)
+        if status is not None and status < 400:
+            self.latency = elapsed if self.latency is None else 0.9 * self.latency + 0.1 * elapsed
+
+        self.done += 1
+        if now - self.last_report >= self.report_interval:
+            if self.logger:
+                latency = f"{self.latency:.2f}s" if self.latency is not None else "n/a"
+                self.logger.info(f"Rate limiter: {self.done / (now - self.last_report):.2f} requests/s, "
+                                 f"limit {self.limit:.1f}, {self.gate.in_use} in flight, average latency {latency}.")
+            self.done = 0
+            self.last_report = now
+
+        self.gate.set_capacity(math.floor(self.limit))
+        self.gate.release()
+
+class KahPoliteFetcher(FetcherABC):
+    """Fetcher wrapper pacing every request by the politeness domain of its host.
+
+    Each request first takes a slot of its host from host_limiter, and the requests to adaptive_hosts are further
+    paced by the adaptive limiter if given. Waiting requests go through in the order of their priority class, given
+    by get_priority(url). The wrapped fetcher should not wait between requests by itself, so that hosts do not wait
+    behind each other.
+
+    With a breaker, the circuit of the host is checked once its slot is held, so that requests queued behind a host
+    that went dead are short-circuited (fetch_now returns None, fetch calls onerr with KahCircuitOpen), and every
+    request sent records its outcome in the breaker."""
+
+    def __init__(self, fetcher: FetcherABC, host_limiter: KahHostLimiter,
+                 adaptive: Optional[KahAimdLimiter] = None, adaptive_hosts: Iterable[str] = (),
+                 get_priority: Optional[Callable[[str], str]] = None,
+                 breaker: Optional[KahCircuitBreaker] = None) -> None:
+        self.fetcher = fetcher
+        self.host_limiter = host_limiter
+        self.adaptive = adaptive
+        self.adaptive_hosts = {host.lower() for host in adaptive_hosts}
+        self.get_priority = get_priority
+        self.breaker = breaker
+
+    @staticmethod
+    def get_status(e: BaseException, resp: Any) -> tuple[Optional[int], Optional[str]]:
+        """HTTP status and Retry-After of a failed request, from its response or its ClientResponseError"""
+        source = resp if resp is not None else e
+        status = getattr(source, "status", None)
+        headers = getattr(source, "headers", None) or {}
+        return status, headers.get("Retry-After")
+
+    async def acquire(self, url: str) -> Callable[..., Awaitable[None]]:
+        """Wait until url may be requested, return the function giving back its slots (status, retry_after)"""
+        priority = self.get_priority(url) if self.get_priority is not None else None
+        await self.host_limiter.acquire(url, priority)
+        started = None
+        if self.adaptive is not None and get_host(url) in self.adaptive_hosts:
+            try:
+                started = await self.adaptive.acquire(priority)
+            except BaseException:
+                self.host_limiter.release(url)
+                raise
+        released = False
+
+        async def release(status: Optional[int] = None, retry_after: Optional[str] = None) -> None:
+            nonlocal released
+            if released:
+                return
+            released = True
+            self.host_limiter.release(url)
+            if started is not None:
+                await self.adaptive.release(started, status, retry_after)
+        return release
+
+    async def fetch(self, url: str, callback: Callable[..., Awaitable], onerr: Callable[..., Awaitable]) -> None:
+        release = await self.acquire(url)
+        if self.breaker is not None and not self.breaker.allow(url): # Went dead while waiting
+            await release()
+            await onerr(self, url, KahCircuitOpen(f"Circuit breaker open for host {get_host(url)}"), None, None)
+            return
+
+        async def _callback(fetcher: FetcherABC, resp: Any, data: bytes):
+            await release(resp.status)
+            if self.breaker is not None:
+                self.breaker.record_success(url)
+            await callback(self, resp, data)
+
+        async def _onerr(fetcher: FetcherABC, url: str, e: Exception, resp: Any = None, data: Optional[bytes] = None):
+            await release(*self.get_status(e, resp))
+            if self.breaker is not None:
+                self.breaker.record_failure(url, e)
+            await onerr(self, url, e, resp, data)
+        await self.fetcher.fetch(url, _callback, _onerr)
+
+    async def fetch_now(self, url: str, onerr: Callable[..., Awaitable]):
+        release = await self.acquire(url)
+        if self.breaker is not None and not self.breaker.allow(url): # Went dead while waiting
+            await release()
+            return None
+
+        async def _onerr(fetcher: FetcherABC, url: str, e: Exception, resp: Any = None, data: Optional[bytes] = None):
+            await release(*self.get_status(e, resp))
+            if self.breaker is not None:
+                self.breaker.record_failure(url, e)
+            await onerr(self, url, e, resp, data)
+        out = None
+        try:
+            out = await self.fetcher.fetch_now(url, _onerr)
+        finally: # No-op if already released by _onerr
+            await release(out[0].status if out is not None else None)
+        if out is not None and self.breaker is not None:
+            self.breaker.record_success(url)
+        return out
+
+    async def wait_and_close(self) -> None:
+        await self.fetcher.wait_and_close()
+
+class KahSingleFlightFetcher(FetcherABC):
+    """Fetcher wrapper sharing one request between concurrent requests of the same url.
+
+    Urls are keyed by get_canonical_url. While the request of a key is in flight, further requests of that key do not
+    reach the wrapped fetcher: they wait for its response, or its error, and then run their own callback or onerr.
+    Responses are not kept once their request is done."""
+
+    def __init__(self, fetcher: FetcherABC, logger: Optional[Logger] = None) -> None:
+        self.fetcher = fetcher
+        self.logger = logger
+        self.inflight: dict[str, asyncio.Future] = {} # key -> (out, error) of its request
+        self.followers: set[asyncio.Task] = set()
+        self.coalesced = 0 # Requests that shared the request of another
+
+    def _lead(self, key: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        return future
+
+    def _settle(self, key: str, future: asyncio.Future, out: Any = None, error: Optional[tuple] = None,
+                cancel: bool = False) -> None:
+        """Give out, error (e, resp, data) or cancellation to the waiting requests, new ones make a new request"""
+        if self.inflight.get(key) is future:
+            del self.inflight[key]
+        if future.done():
+            return
+        if cancel:
+            future.cancel()
+        else:
+            future.set_result((out, error))
+
+    async def _follow(self, future: asyncio.Future, url: str, onerr: Callable[..., Awaitable]) -> Any:
+        self.coalesced += 1
+        out, error = await asyncio.shield(future)
+        if error is not None:
+            await onerr(self, url, *error)
+        return out
+
+    async def fetch(self, url: str, callback: Callable[..., Awaitable], onerr: Callable[..., Awaitable]) -> None:
+        key = get_canonical_url(url)
+        future = self.inflight.get(key)
+        if future is not None:
+            async def follow() -> None:
+                out = await self._follow(future, url, onerr)
+                if out is not None:
+                    await callback(self, *out)
+            task = asyncio.create_task(follow())
+            self.followers.add(task)
+            task.add_done_callback(self.followers.discard)
+            return
+
+        future = self._lead(key)
+
+        async def _callback(fetcher: FetcherABC, resp: Any, data: bytes):
+            self._settle(key, future, (resp, data))
+            await callback(self, resp, data)
+
+        async def _onerr(fetcher: FetcherABC, url: str, e: Exception, resp: Any = None, data: Optional[bytes] = None):
+            self._settle(key, future, error=(e, resp, data))
+            await onerr(self, url, e, resp, data)
+        try:
+            await self.fetcher.fetch(url, _callback, _onerr)
+        except Exception as e:
+            self._settle(key, future, error=(e, None, None))
+            raise
+        except BaseException:
+            self._settle(key, future, cancel=True)
+            raise
+
+    async def fetch_now(self, url: str, onerr: Callable[..., Awaitable]):
+        key = get_canonical_url(url)
+        future = self.inflight.get(key)
+        if future is not None:
+            return await self._follow(future, url, onerr)
+
+        future = self._lead(key)
+
+        async def _onerr(fetcher: FetcherABC, url: str, e: Exception, resp: Any = None, data: Optional[bytes] = None):
+            self._settle(key, future, error=(e, resp, data))
+            await onerr(self, url, e, resp, data)
+        try:
+            out = await self.fetcher.fetch_now(url, _onerr)
+        except Exception as e:
+            self._settle(key, future, error=(e, None, None))
+            raise
+        except BaseException:
+            self._settle(key, future, cancel=True)
+            raise
+        self._settle(key, future, out)
+        return out
+
+    async def wait_and_close(self) -> None:
+        while self.followers:
+            await asyncio.gather(*self.followers, return_exceptions=True)
+        if self.logger and self.coalesced:
+            self.logger.info(f"Shared {self.coalesced} requests with identical ones in flight.")
+        await self.fetcher.wait_and_close()
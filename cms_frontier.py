@@ -0,0 +1,260 @@
+"""
+Crawl frontier: urls waiting to be fetched
+"""
+import os
+import time
+import asyncio
+from pathlib import Path
+from logging import Logger
+from collections import deque
+from typing import Callable, Iterable, Optional, Sequence, TextIO
+from cms_index import KahFingerprintSet
+
+class KahSpillQueue:
+    """FIFO of urls keeping at most max_memory of them in memory, the overflow going to a spill file"""
+
+    def __init__(self, path_spill: Path, max_memory: int = 1024, max_spill: Optional[int] = 1_000_000) -> None:
+        self.path_spill = path_spill
+        self.max_memory = max_memory
+        self.max_spill = max_spill # None for no limit
+        self.memory: deque[str] = deque()
+        self.spilled = 0 # Urls in the spill file not read back yet
+        self._read_offset = 0
+        self._spill: Optional[TextIO] = None
+
+    def __len__(self) -> int:
+        return len(self.memory) + self.spilled
+
+    def has_room(self) -> bool:
+        if self.spilled == 0 and len(self.memory) < self.max_memory:
+            return True
+        return self.max_spill is None or self.spilled < self.max_spill
+
+    def push(self, url: str) -> None:
+        if self.spilled == 0 and len(self.memory) < self.max_memory:
+            self.memory.append(url)
+            return
+        if self._spill is None: # Keep the order, once spilling everything goes through the file
+            self.path_spill.parent.mkdir(parents=True, exist_ok=True)
+            self._spill = open(self.path_spill, "a", encoding="utf-8")
+        self._spill.write(url + "\n")
+        self.spilled += 1
+
+    def _refill(self) -> None:
+        """Read the next urls of the spill file back in memory"""
+        self._spill.flush()
+        with open(self.path_spill, "r", encoding="utf-8") as f:
+            f.seek(self._read_offset)
+            while len(self.memory) < self.max_memory and self.spilled > 0:
+                self.memory.append(f.readline().rstrip("\n"))
+                self.spilled -= 1
+            self._read_offset = f.tell()
+        if self.spilled == 0: # Fully read back, start over
+            self.close()
+
+    def pop(self) -> str:
+        if not self.memory and self.spilled:
+            self._refill()
+        return self.memory.popleft()
+
+    def close(self) -> None:
+        """Drop the spill file"""
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        self.path_spill.unlink(missing_ok=True)
+        self._read_offset = 0
+
+class KahFrontier:
+    """Bounded crawl frontier with one KahSpillQueue per priority class.
+
+    get_class(url) gives the class of an url, unknown classes go to the last one. put waits while the queue of its
+    class is full, in memory and on disk. Like asyncio.Queue, every url taken with get must be marked with task_done
+    once handled, and join waits until all urls put were handled. put_many queues a batch at once, leaving out the
+    urls already waiting or being handled, known by their 64-bit fingerprint so that spilled urls stay on disk.
+    put_later adds an url after a delay without waiting for it, join waiting for it meanwhile.
+
+    Every put and task_done is journaled to path_dir/journal.txt ("+url" and "-url" lines), flushed to disk every
+    checkpoint_interval seconds and on close. resume gives back the urls an interrupted run left unhandled, in order.
+    finish drops the journal once the crawl is complete."""
+
+    def __init__(self,
+                 path_dir: Path,
+                 classes: Sequence[str] = ("default",),
+                 get_class: Optional[Callable[[str], str]] = None,
+                 max_memory: int = 1024,
+                 max_spill: Optional[int] = 1_000_000,
+                 checkpoint_interval: float = 5.0,
+                 logger: Optional[Logger] = None) -> None:
+        self.path_dir = path_dir
+        self.classes = list(classes)
+        self.get_class = get_class
+        self.checkpoint_interval = checkpoint_interval
+        self.logger = logger
+        self.path_journal = path_dir / "journal.txt"
+        self._journal: Optional[TextIO] = None
+        self._flushed_at = time.monotonic()
+        self.queues = {c: KahSpillQueue(path_dir / f"{c}.spill", max_memory, max_spill) for c in self.classes}
+        for queue in self.queues.values(): # Left by an interrupted run
+            queue.close()
+        self.condition = asyncio.Condition()
+        self.unfinished = 0
+        self.pending = KahFingerprintSet(64) # Urls put and not handled yet
+        self.pending_extra: dict[int, int] = {} # fingerprint -> times put again while pending, e.g. retries
+        self.finished = asyncio.Event()
+        self.finished.set()
+        self.delayed: set[asyncio.Task] = set() # put_later waiting for their delay
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    # =======================
+    # Checkpoint
+    # =======================
+
+    async def resume(self) -> list[str]:
+        """Put back the urls left unhandled by an interrupted run, in the order they were put, and return them"""
+        pending: dict[str, int] = {} # url -> times put but not handled
+        if self.path_journal.exists():
+            with open(self.path_journal, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.endswith("\n"): # Cut by a crash
+                        break
+                    url = line[1:-1]
+                    if line[0] == "+":
+                        pending[url] = pending.get(url, 0) + 1
+                    elif pending.get(url, 0) > 1:
+                        pending[url] -= 1
+                    else:
+                        pending.pop(url, None)
+        if not pending:
+            self.path_journal.unlink(missing_ok=True)
+            return []
+        if self.logger:
+            self.logger.info(f"Resuming frontier from path={self.path_journal}: {len(pending)} urls left.")
+        path_tmp = self.path_journal.with_suffix(".tmp") # Compact the journal, replaced only once complete
+        with open(path_tmp, "w", encoding="utf-8") as f:
+            f.writelines(f"+{url}\n" for url in pending)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path_tmp, self.path_journal)
+        await self.put_many(pending, log=False)
+        return list(pending)
+
+    def _log(self, op: str, url: str) -> None:
+        if self._journal is None:
+            self.path_dir.mkdir(parents=True, exist_ok=True)
+            self._journal = open(self.path_journal, "a", encoding="utf-8")
+        self._journal.write(f"{op}{url}\n")
+        if time.monotonic() - self._flushed_at >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def checkpoint(self) -> None:
+        """Write the journal to disk"""
+        if self._journal is not None:
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+        self._flushed_at = time.monotonic()
+
+    # =======================
+    # Queue
+    # =======================
+
+    def get_queue(self, url: str) -> KahSpillQueue:
+        cls = self.get_class(url) if self.get_class is not None else self.classes[-1]
+        return self.queues.get(cls, self.queues[self.classes[-1]])
+
+    async def put(self, url: str, log: bool = True) -> None:
+        """Add url, waiting while its queue is full"""
+        queue = self.get_queue(url)
+        async with self.condition:
+            if not queue.has_room() and self.logger:
+                self.logger.debug(f"Frontier full, waiting to add {url}.")
+            await self.condition.wait_for(queue.has_room)
+            self._push(queue, url, log)
+            self.condition.notify_all()
+
+    def _push(self, queue: KahSpillQueue, url: str, log: bool) -> None:
+        queue.push(url)
+        if log:
+            self._log("+", url)
+        fp = self.pending.fingerprint(url)
+        if fp in self.pending:
+            self.pending_extra[fp] = self.pending_extra.get(fp, 0) + 1
+        else:
+            self.pending.add(fp)
+        self.unfinished += 1
+        self.finished.clear()
+
+    async def put_many(self, urls: Iterable[str], skip: Optional[Callable[[str], bool]] = None, log: bool = True) -> int:
+        """Add urls not waiting nor being handled yet, and for which skip is not true, in one go. Return how many
+        were added"""
+        added = 0
+        async with self.condition:
+            for url in urls:
+                if self.pending.fingerprint(url) in self.pending or (skip is not None and skip(url)):
+                    continue
+                queue = self.get_queue(url)
+                if not queue.has_room():
+                    self.condition.notify_all() # Let consumers make room
+                    await self.condition.wait_for(queue.has_room)
+                self._push(queue, url, log)
+                added += 1
+            self.condition.notify_all()
+        return added
+
+    def put_later(self, url: str, delay: float) -> None:
+        """Add url once delay seconds passed. It is journaled right away, so that it is resumed if interrupted before"""
+        self._log("+", url)
+        self.unfinished += 1 # Held until it is put
+        self.finished.clear()
+        task = asyncio.create_task(self._put_later(url, delay))
+        self.delayed.add(task)
+        task.add_done_callback(self.delayed.discard)
+
+    async def _put_later(self, url: str, delay: float) -> None:
+        await asyncio.sleep(delay)
+        await self.put(url, log=False)
+        self.unfinished -= 1 # Handed over to the put
+
+    async def get(self, cls: str) -> str:
+        """Next url of class cls, waiting for one if needed"""
+        queue = self.queues[cls]
+        async with self.condition:
+            await self.condition.wait_for(lambda: len(queue) > 0)
+            url = queue.pop()
+            self.condition.notify_all()
+            return url
+
+    def task_done(self, url: str) -> None:
+        """Mark url, taken with get, as handled"""
+        self._log("-", url)
+        fp = self.pending.fingerprint(url)
+        if fp in self.pending_extra:
+            self.pending_extra[fp] -= 1
+            if not self.pending_extra[fp]:
+                del self.pending_extra[fp]
+        else:
+            self.pending.discard(fp)
+        self.unfinished -= 1
+        if self.unfinished <= 0:
+            self.finished.set()
+
+    async def join(self) -> None:
+        await self.finished.wait()
+
+    def close(self) -> None:
+        """Save the journal and drop the spill files, the urls left can be resumed from the journal"""
+        for task in self.delayed:
+            task.cancel()
+        if self._journal is not None:
+            self.checkpoint()
+            self._journal.close()
+            self._journal = None
+        for queue in self.queues.values():
+            queue.close()
+
+    def finish(self) -> None:
+        """Close and drop the journal, nothing is left to resume"""
+        self.close()
+        self.path_journal.unlink(missing_ok=True)
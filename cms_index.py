@@ -0,0 +1,574 @@
+"""
+Storage backends for the index of downloaded urls
+"""
+import os
+import mmap
+import heapq
+import shutil
+import hashlib
+import sqlite3
+import threading
+from array import array
+from abc import ABC, abstractmethod
+from pathlib import Path
+from logging import Logger
+from typing import Iterable, Iterator, Literal, Optional, TextIO
+
+FsyncPolicy = Literal["never", "flush", "close"]
+
+class KahIndexBackend(ABC):
+    """Storage of downloaded urls, written in groups.
+
+    Added urls are pending until flush_size of them are waiting or flush_interval seconds passed since the first one,
+    then written as one group; close always flushes. fsync_policy tells when writes are synced to disk: never (leave it
+    to the OS), at every flush, or on close only."""
+
+    def __init__(self,
+                 flush_size: int = 64,
+                 flush_interval: float = 1.0,
+                 fsync_policy: FsyncPolicy = "never",
+                 logger: Optional[Logger] = None) -> None:
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.fsync_policy = fsync_policy
+        self.logger = logger
+        self._pending: dict[str, None] = {} # Ordered set
+        self._timer: Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def contains(self, url: str) -> bool:
+        """Whether url was marked as downloaded"""
+
+    @abstractmethod
+    def _write_group(self, urls: list[str]) -> None:
+        """Write urls to storage, called holding _lock"""
+
+    @abstractmethod
+    def _close_storage(self) -> None:
+        """Release the storage, called holding _lock. It is reopened on next write if needed."""
+
+    def add(self, url: str) -> None:
+        """Mark url as downloaded"""
+        self.add_many((url,))
+
+    def add_many(self, urls: Iterable[str]) -> None:
+        """Mark all urls as downloaded"""
+        with self._lock:
+            self._pending.update(dict.fromkeys(urls))
+            if len(self._pending) >= self.flush_size:
+                self._flush()
+            elif self._pending and self._timer is None and self.flush_interval > 0:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self) -> None:
+        """Write pending urls to storage"""
+        with self._lock:
+            self._flush()
+
+    def close(self) -> None:
+        """Flush pending urls and release the storage"""
+        with self._lock:
+            self._flush()
+            self._close_storage()
+
+    def compact(self) -> None:
+        """Rewrite the storage in its most compact form, if relevant"""
+        self.flush()
+
+    def _flush(self) -> None:
+        """Write pending urls as one group, must hold _lock"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        self._write_group(list(self._pending))
+        self._pending.clear()
+
+# =======================
+# Text file
+# =======================
+
+class KahTextIndexBackend(KahIndexBackend):
+    """Urls kept in memory, journaled to a text file with one url per line"""
+
+    def __init__(self, path_index: Path, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.path_index = path_index
+        self.urls: set[str] = set()
+        self._file: Optional[TextIO] = None
+
+        # Load it if exists
+        if self.path_index.exists():
+            if self.logger:
+                self.logger.debug(f"Loading downloaded urls from index file at path={self.path_index}.")
+            self._load()
+        else: # create
+            if self.logger:
+                self.logger.debug(f"Creating new downloaded urls index file at path={self.path_index}.")
+            self.path_index.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path_index, "w+", encoding="utf-8") as f:
+                f.write("")
+
+    def _load(self) -> None:
+        """Load the existing index file"""
+        with open(self.path_index, "r", encoding="utf-8") as f:
+            self.urls = set(f.read().splitlines())
+
+    def contains(self, url: str) -> bool:
+        return url in self.urls
+
+    def add_many(self, urls: Iterable[str]) -> None:
+        urls = list(urls)
+        self.urls.update(urls)
+        super().add_many(urls)
+
+    def _write_group(self, urls: list[str]) -> None:
+        if self._file is None:
+            self._file = open(self.path_index, "a+", encoding="utf-8")
+        self._file.write("".join(url + "\n" for url in urls))
+        self._file.flush()
+        if self.fsync_policy == "flush":
+            os.fsync(self._file.fileno())
+
+    def _close_storage(self) -> None:
+        if self._file is not None:
+            if self.fsync_policy == "close":
+                os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+    def compact(self) -> None:
+        """Rewrite the index file sorted and without duplicates"""
+        if self.logger:
+            self.logger.info(f"Saving downloaded URLs to index file at path={self.path_index}.")
+        self.close() # Pending urls are already in self.urls, release the journal before rewriting
+        self.path_index.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path_index, "w", encoding="utf-8") as f:
+            f.writelines(url + "\n" for url in sorted(self.urls))
+
+# =======================
+# Fingerprints
+# =======================
+
+class KahFingerprintSet:
+    """Hash set of fixed-width url fingerprints, stored in a flat array with open addressing"""
+    MAX_LOAD = 0.7
+
+    def __init__(self, bits: Literal[32, 64] = 64, capacity: int = 1024) -> None:
+        self.bits = bits
+        self.typecode = "Q" if bits == 64 else "I"
+        self.size = 0
+        self._alloc(max(capacity, 8))
+
+    def _alloc(self, capacity: int) -> None:
+        """Allocate an empty table of at least capacity slots (power of 2)"""
+        capacity = 1 << (capacity - 1).bit_length()
+        self.table = array(self.typecode, bytes(capacity * array(self.typecode).itemsize))
+        self.mask = capacity - 1
+
+    def fingerprint(self, url: str) -> int:
+        """Non-zero fingerprint of url, 0 marks empty slots"""
+        digest = hashlib.blake2b(url.encode("utf-8"), digest_size=self.bits // 8).digest()
+        return int.from_bytes(digest, "little") or 1
+
+    def add(self, fp: int) -> None:
+        if (self.size + 1) > self.MAX_LOAD * len(self.table):
+            old = self.table
+            self._alloc(len(old) * 2)
+            self.size = 0
+            for v in old:
+                if v:
+                    self.add(v)
+        table, mask = self.table, self.mask
+        i = fp & mask
+        while True:
+            v = table[i]
+            if v == 0:
+                table[i] = fp
+                self.size += 1
+                return
+            if v == fp:
+                return
+            i = (i + 1) & mask
+
+    def discard(self, fp: int) -> None:
+        """Remove fp if present, shifting back the fingerprints probed past it so that lookups still find them"""
+        table, mask = self.table, self.mask
+        i = fp & mask
+        while True:
+            v = table[i]
+            if v == 0:
+                return
+            if v == fp:
+                break
+            i = (i + 1) & mask
+        j = i
+        while True:
+            j = (j + 1) & mask
+            v = table[j]
+            if v == 0:
+                break
+            home = v & mask
+            if (i < j and i < home <= j) or (i > j and (home > i or home <= j)): # Still reachable from its home slot
+                continue
+            table[i] = v
+            i = j
+        table[i] = 0
+        self.size -= 1
+
+    def __contains__(self, fp: int) -> bool:
+        table, mask = self.table, self.mask
+        i = fp & mask
+        while True:
+            v = table[i]
+            if v == fp:
+                return True
+            if v == 0:
+                return False
+            i = (i + 1) & mask
+
+    def __len__(self) -> int:
+        return self.size
+
+class KahFingerprintIndexBackend(KahTextIndexBackend):
+    """Text index kept in memory as fixed-width fingerprints instead of full urls.
+
+    Uses 8 (bits=64) or 4 (bits=32) bytes per url and slack instead of a full string per url. A fingerprint hit is
+    exact up to hash collisions; with verify=True hits are confirmed against the on-disk index: by binary search in
+    its sorted part (as written by compact), urls out of that part being kept in memory."""
+
+    def __init__(self, path_index: Path, bits: Literal[32, 64] = 64, verify: bool = False, **kwargs) -> None:
+        self.fingerprints = KahFingerprintSet(bits)
+        self.verify = verify
+        self._sorted_end = 0 # Index file is sorted up to this byte offset
+        super().__init__(path_index, **kwargs)
+
+    def _load(self) -> None:
+        """Fingerprint the index file line by line, find its sorted part"""
+        self.fingerprints = KahFingerprintSet(self.fingerprints.bits, capacity=int(self.path_index.stat().st_size / 40 / KahFingerprintSet.MAX_LOAD))
+        offset, prev, is_sorted = 0, b"", True
+        with open(self.path_index, "rb") as f:
+            for line in f:
+                key = line.rstrip(b"\r\n")
+                if key:
+                    url = key.decode("utf-8")
+                    self.fingerprints.add(self.fingerprints.fingerprint(url))
+                    if is_sorted and key < prev:
+                        is_sorted = False
+                    if not is_sorted and self.verify:
+                        self.urls.add(url)
+                    prev = key
+                offset += len(line)
+                if is_sorted:
+                    self._sorted_end = offset
+
+    def contains(self, url: str) -> bool:
+        if self.fingerprints.fingerprint(url) not in self.fingerprints:
+            return False
+        if not self.verify or url in self.urls:
+            return True
+        return self._in_sorted_part(url.encode("utf-8")) # Ambiguous hit
+
+    def _in_sorted_part(self, key: bytes) -> bool:
+        """Binary search key in the sorted part of the index file"""
+        with open(self.path_index, "rb") as f:
+            lo, hi = 0, self._sorted_end
+            while lo < hi:
+                mid = (lo + hi) // 2
+                start = mid
+                if mid > 0: # Move to the first line starting at or after mid
+                    f.seek(mid - 1)
+                    f.readline()
+                    start = f.tell()
+                if start >= hi:
+                    hi = mid
+                    continue
+                f.seek(start)
+                line = f.readline()
+                current = line.rstrip(b"\r\n")
+                if current == key:
+                    return True
+                if current < key:
+                    lo = start + len(line)
+                else:
+                    hi = start
+        return False
+
+    def add_many(self, urls: Iterable[str]) -> None:
+        urls = list(urls)
+        for url in urls:
+            self.fingerprints.add(self.fingerprints.fingerprint(url))
+        if self.verify: # Appended after the sorted part
+            self.urls.update(urls)
+        KahIndexBackend.add_many(self, urls)
+
+    def compact(self) -> None:
+        """Merge the unsorted tail of the index file into its sorted part, streaming the sorted part"""
+        if self.logger:
+            self.logger.info(f"Compacting downloaded URLs index file at path={self.path_index}.")
+        self.close()
+        with open(self.path_index, "rb") as f:
+            f.seek(self._sorted_end)
+            tail = sorted({line.rstrip(b"\r\n") for line in f} - {b""})
+        if not tail:
+            return
+        path_tmp = self.path_index.with_suffix(self.path_index.suffix + ".tmp")
+        with open(self.path_index, "rb") as f_in, open(path_tmp, "wb") as f_out:
+            def read_sorted_part() -> Iterator[bytes]:
+                while f_in.tell() < self._sorted_end:
+                    yield f_in.readline().rstrip(b"\r\n")
+            prev = None
+            for key in heapq.merge(read_sorted_part(), tail):
+                if key and key != prev:
+                    f_out.write(key + b"\n")
+                prev = key
+            self._sorted_end = f_out.tell()
+        os.replace(path_tmp, self.path_index)
+        self.urls.clear()
+
+# =======================
+# Memory-mapped sorted index
+# =======================
+
+def bisect_sorted_lines(buf: bytes | mmap.mmap, key: bytes) -> bool:
+    """Whether key is a line of buf, which holds sorted lines ending with a newline"""
+    lo, hi = 0, len(buf) # Both always at a line start
+    while lo < hi:
+        mid = (lo + hi) // 2
+        i = buf.rfind(b"\n", lo, mid)
+        start = i + 1 if i >= 0 else lo
+        end = buf.find(b"\n", start, hi)
+        if end < 0:
+            end = hi
+        line = buf[start:end]
+        if line == key:
+            return True
+        if line < key:
+            lo = end + 1
+        else:
+            hi = start
+    return False
+
+class KahMmapIndexBackend(KahIndexBackend):
+    """Sorted index file searched in place through mmap, plus a small append-only tail.
+
+    Startup only maps the sorted file and reads the tail, whatever the index size. Once the tail holds
+    compact_threshold urls it is rotated out and merged into the sorted file by a background thread. Files are
+    path_index with suffixes .sorted, .tail and .compacting (tail being merged); an existing text index at
+    path_index is imported once when no sorted file exists yet."""
+
+    def __init__(self, path_index: Path, compact_threshold: int = 10000, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.compact_threshold = compact_threshold
+        self.path_sorted = path_index.with_suffix(".sorted")
+        self.path_tail = path_index.with_suffix(".tail")
+        self.path_compacting = path_index.with_suffix(".compacting")
+        self._tail: set[str] = set()
+        self._compacting: set[str] = set()
+        self._tail_file: Optional[TextIO] = None
+        self._sorted_file = None
+        self._sorted: Optional[mmap.mmap] = None
+        self._compactor: Optional[threading.Thread] = None
+
+        self.path_sorted.parent.mkdir(parents=True, exist_ok=True)
+        if not self.path_sorted.exists():
+            if path_index.exists() and not self.path_compacting.exists():
+                if self.logger:
+                    self.logger.info(f"Importing text index at path={path_index} into sorted index at path={self.path_sorted}.")
+                shutil.copyfile(path_index, self.path_compacting)
+            self.path_sorted.touch()
+        self._tail = self._read_lines(self.path_tail)
+        self._compacting = self._read_lines(self.path_compacting)
+        with self._lock:
+            self._open_sorted()
+            if self._compacting: # Left over by an interrupted compaction
+                self._start_compaction()
+
+    @staticmethod
+    def _read_lines(path: Path) -> set[str]:
+        if not path.exists():
+            return set()
+        with open(path, "r", encoding="utf-8") as f:
+            return set(f.read().splitlines()) - {""}
+
+    def _open_sorted(self) -> None:
+        """Map the sorted index file, must hold _lock"""
+        self._sorted_file = open(self.path_sorted, "rb")
+        if os.fstat(self._sorted_file.fileno()).st_size > 0: # Empty files cannot be mapped
+            self._sorted = mmap.mmap(self._sorted_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _close_sorted(self) -> None:
+        """Unmap the sorted index file, must hold _lock"""
+        if self._sorted is not None:
+            self._sorted.close()
+            self._sorted = None
+        if self._sorted_file is not None:
+            self._sorted_file.close()
+            self._sorted_file = None
+
+    def contains(self, url: str) -> bool:
+        if url in self._tail or url in self._compacting:
+            return True
+        with self._lock:
+            if self._sorted_file is None:
+                self._open_sorted()
+            return self._sorted is not None and bisect_sorted_lines(self._sorted, url.encode("utf-8"))
+
+    def add_many(self, urls: Iterable[str]) -> None:
+        urls = list(urls)
+        self._tail.update(urls)
+        super().add_many(urls)
+
+    def _write_group(self, urls: list[str]) -> None:
+        if self._tail_file is None:
+            self._tail_file = open(self.path_tail, "a+", encoding="utf-8")
+        self._tail_file.write("".join(url + "\n" for url in urls))
+        self._tail_file.flush()
+        if self.fsync_policy == "flush":
+            os.fsync(self._tail_file.fileno())
+        if len(self._tail) >= self.compact_threshold and self._compactor is None:
+            self._start_compaction()
+
+    def _close_tail(self) -> None:
+        if self._tail_file is not None:
+            if self.fsync_policy == "close":
+                os.fsync(self._tail_file.fileno())
+            self._tail_file.close()
+            self._tail_file = None
+
+    def _close_storage(self) -> None:
+        self._close_tail()
+        self._close_sorted()
+
+    def compact(self) -> None:
+        """Compaction runs in the background once the tail is large enough, only flush here"""
+        self.flush()
+
+    def _start_compaction(self) -> None:
+        """Rotate the tail out if no compaction is pending, and merge it in a background thread, must hold _lock"""
+        if not self._compacting:
+            self._close_tail()
+            os.replace(self.path_tail, self.path_compacting)
+            self._compacting, self._tail = self._tail, set()
+        self._compactor = threading.Thread(target=self._compact_worker, name="KahMmapIndexCompactor", daemon=True)
+        self._compactor.start()
+
+    def _compact_worker(self) -> None:
+        """Merge the rotated tail into the sorted index file"""
+        try:
+            if self.logger:
+                self.logger.debug(f"Compacting {len(self._compacting)} urls into sorted index at path={self.path_sorted}.")
+            path_tmp = self.path_sorted.with_suffix(".sorted.tmp")
+            additions = sorted(url.encode("utf-8") for url in self._compacting)
+            with open(self.path_sorted, "rb") as f_in, open(path_tmp, "wb") as f_out:
+                prev = None
+                for key in heapq.merge((line.rstrip(b"\n") for line in f_in), additions):
+                    if key and key != prev:
+                        f_out.write(key + b"\n")
+                    prev = key
+                f_out.flush()
+                os.fsync(f_out.fileno()) # The compacting tail is deleted right after
+            with self._lock:
+                self._close_sorted()
+                os.replace(path_tmp, self.path_sorted)
+                self.path_compacting.unlink()
+                self._compacting = set()
+                self._open_sorted()
+        except Exception as e:
+            if self.logger:
+                self.logger.error(f"Failed to compact sorted index at path={self.path_sorted}: {e=}")
+        finally:
+            self._compactor = None
+
+# =======================
+# SQLite
+# =======================
+
+class KahSqliteIndexBackend(KahIndexBackend):
+    """Urls stored in a SQLite database in WAL mode, one namespace per event.
+
+    Lookups use the (namespace, url) primary key, nothing is loaded in memory. Several processes can share the
+    database: writers wait up to timeout seconds for each other."""
+
+    def __init__(self, path_db: Path, namespace: str = "", timeout: float = 30.0, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.path_db = path_db
+        self.namespace = namespace
+        self.timeout = timeout
+        self._conn: Optional[sqlite3.Connection] = None
+        self._connection() # Create db early to fail early
+
+    def _connection(self) -> sqlite3.Connection:
+        """Open the connection if needed, must hold _lock or be in __init__"""
+        if self._conn is None:
+            if self.logger:
+                self.logger.debug(f"Opening downloaded urls database at path={self.path_db} namespace={self.namespace}.")
+            self.path_db.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.path_db, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(f"PRAGMA synchronous={'FULL' if self.fsync_policy == 'flush' else 'NORMAL'}")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS downloaded ("
+                "namespace TEXT NOT NULL, url TEXT NOT NULL, PRIMARY KEY (namespace, url)"
+                ") WITHOUT ROWID"
+            )
+        return self._conn
+
+    def contains(self, url: str) -> bool:
+        with self._lock:
+            if url in self._pending:
+                return True
+            row = self._connection().execute(
+                "SELECT 1 FROM downloaded WHERE namespace = ? AND url = ?", (self.namespace, url)
+            ).fetchone()
+            return row is not None
+
+    def is_empty(self) -> bool:
+        """Whether the namespace holds no url"""
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT 1 FROM downloaded WHERE namespace = ? LIMIT 1", (self.namespace,)
+            ).fetchone()
+            return row is None and not self._pending
+
+    def import_text_index(self, path_index: Path, batch_size: int = 10000) -> None:
+        """Add all urls of a text index file (one url per line) to the namespace"""
+        if self.logger:
+            self.logger.info(f"Importing text index at path={path_index} into namespace={self.namespace}.")
+        with open(path_index, "r", encoding="utf-8") as f:
+            batch = []
+            for line in f:
+                url = line.rstrip("\n")
+                if url:
+                    batch.append(url)
+                if len(batch) >= batch_size:
+                    with self._lock:
+                        self._write_group(batch)
+                    batch = []
+            if batch:
+                with self._lock:
+                    self._write_group(batch)
+
+    def _write_group(self, urls: list[str]) -> None:
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE") # Take the write lock now, waits for other processes up to timeout
+        try:
+            conn.executemany(
+                "INSERT OR IGNORE INTO downloaded (namespace, url) VALUES (?, ?)",
+                ((self.namespace, url) for url in urls)
+            )
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _close_storage(self) -> None:
+        if self._conn is not None:
+            if self.fsync_policy == "close":
+                self._conn.execute("PRAGMA wal_checkpoint(FULL)")
+            self._conn.close()
+            self._conn = None
@@ -1,14 +1,18 @@
 """
 Common utils
 """
+import time
+import asyncio
 import logging
 import aiofiles
 from pathlib import Path
+from collections import deque
+from urllib.parse import urlsplit
 from bs4 import Tag
 from kahscrape.kahscrape import FetcherABC
 from aiohttp import ClientResponse
 from cms_skip import KahSkipManager
-from typing import Optional
+from typing import NamedTuple, Optional, Sequence
 
 def redirect_url(url: str) -> str:
     """Replace given url to take into account manually-defined new urls"""
@@ -59,6 +63,124 @@ class KahLogger(logging.Logger):
         self.addHandler(file_handler)
         self.addHandler(console_handler)
 
+class KahHostPolicy(NamedTuple):
+    """Politeness settings of a host: concurrent requests, and a token bucket of burst requests refilled every interval seconds"""
+    concurrency: int = 4
+    interval: float = 0.0
+    burst: int = 1
+
+class KahPriorityGate:
+    """Semaphore handing free slots to waiters by priority class, highest first.
+
+    classes are ordered from highest to lowest priority, unknown classes count as the lowest. A class whose share of
+    recent grants is below its min_shares entry goes first, so that lower classes are never starved. Capacity may be
+    changed at any time."""
+    def __init__(self, capacity: int, classes: Sequence[str] = ("default",), min_shares: Optional[dict[str, float]] = None,
+                 decay: float = 0.99) -> None:
+        self.capacity = capacity
+        self.classes = list(classes)
+        self.min_shares = min_shares or {}
+        self.decay = decay # Weight of past grants in the shares, per grant
+        self.in_use = 0
+        self.waiters: dict[str, deque[asyncio.Future]] = {c: deque() for c in self.classes}
+        self.served: dict[str, float] = {c: 0.0 for c in self.classes}
+
+    def set_capacity(self, capacity: int) -> None:
+        self.capacity = capacity
+        self._wake()
+
+    def _grant(self, priority: str) -> None:
+        self.in_use += 1
+        for c in self.served:
+            self.served[c] *= self.decay
+        self.served[priority] += 1.0
+
+    def _pick(self) -> Optional[str]:
+        """Class of the next waiter to let through, None if nobody waits"""
+        waiting = [c for c in self.classes if self.waiters[c]]
+        if not waiting:
+            return None
+        total = sum(self.served.values()) or 1.0
+        deficits = {c: self.min_shares.get(c, 0.0) - self.served[c] / total for c in waiting}
+        starving = [c for c in waiting if deficits[c] > 0]
+        if starving:
+            return max(starving, key=deficits.__getitem__)
+        return waiting[0]
+
+    def _wake(self) -> None:
+        while self.in_use < self.capacity:
+            priority = self._pick()
+            if priority is None:
+                return
+            future = self.waiters[priority].popleft()
+            if future.done(): # Cancelled while waiting
+                continue
+            self._grant(priority)
+            future.set_result(None)
+
+    async def acquire(self, priority: Optional[str] = None) -> None:
+        priority = priority if priority in self.waiters else self.classes[-1]
+        if self.in_use < self.capacity and not any(self.waiters.values()):
+            self._grant(priority)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[priority].append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled(): # Granted, but cancelled before running
+                self.release()
+            elif future in self.waiters[priority]:
+                self.waiters[priority].remove(future)
+            raise
+
+    def release(self) -> None:
+        self.in_use -= 1
+        self._wake()
+
+class KahHostLimiter:
+    """Politeness domains: bound concurrency and request rate separately for every host.
+
+    Requests waiting for a host are let through by priority class, see KahPriorityGate."""
+    def __init__(self, default: KahHostPolicy = KahHostPolicy(), policies: Optional[dict[str, KahHostPolicy]] = None,
+                 classes: Sequence[str] = ("default",), min_shares: Optional[dict[str, float]] = None) -> None:
+        self.default = default
+        self.policies = {host.lower(): policy for host, policy in (policies or {}).items()} # Overrides default
+        self.classes = classes
+        self.min_shares = min_shares
+        self.gates: dict[str, KahPriorityGate] = {}
+        self.tokens: dict[str, float] = {} # host -> tokens left, negative when requests are waiting for refill
+        self.refilled_at: dict[str, float] = {}
+
+    def get_policy(self, host: str) -> KahHostPolicy:
+        return self.policies.get(host, self.default)
+
+    async def acquire(self, url: str, priority: Optional[str] = None) -> None:
+        """Take a slot and a token of the url's host, to give back with release"""
+        host = (urlsplit(url).hostname or "").lower()
+        policy = self.get_policy(host)
+        gate = self.gates.get(host)
+        if gate is None:
+            gate = self.gates[host] = KahPriorityGate(policy.concurrency, self.classes, self.min_shares)
+        await gate.acquire(priority)
+        if policy.interval <= 0:
+            return
+        now = time.monotonic()
+        tokens = self.tokens.get(host, float(policy.burst))
+        tokens = min(float(policy.burst), tokens + (now - self.refilled_at.get(host, now)) / policy.interval)
+        self.tokens[host] = tokens - 1 # Reserve the token now, so that waiting requests queue up in order
+        self.refilled_at[host] = now
+        if tokens < 1:
+            try:
+                await asyncio.sleep((1 - tokens) * policy.interval)
+            except BaseException:
+                gate.release()
+                raise
+
+    def release(self, url: str) -> None:
+        host = (urlsplit(url).hostname or "").lower()
+        self.gates[host].release()
+
 async def callback_image_save(fetcher: FetcherABC, resp: ClientResponse, data: bytes, logger: KahLogger, save_file_path: Path, skipper: Optional[KahSkipManager] = None):
     """For cutlist xml pages"""
     logger.info(f"Successfully fetched image {resp.url} ({len(data)} bytes)")
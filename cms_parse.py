@@ -0,0 +1,132 @@
+"""
+Parsers for the catalog xml pages
+"""
+import io
+from lxml import etree
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+# =======================
+# Cutlist pages
+# =======================
+
+def parse_cutlist(data: bytes) -> tuple[Optional[int], list[str]]:
+    """Total page count (全ページ数, None if absent) and 公開サークルId of every Circle of a cutlist page, in one streaming pass.
+    (None, []) if the page is empty or not xml"""
+    last_page = None
+    circle_ids = []
+    try:
+        for _, element in etree.iterparse(io.BytesIO(data), events=("end",), tag=("{*}全ページ数", "{*}Circle"), recover=True):
+            if etree.QName(element).localname == "Circle":
+                cid = element.get("公開サークルId")
+                if cid is not None:
+                    circle_ids.append(cid)
+            elif element.text is not None:
+                last_page = int(element.text.strip())
+            # Drop what was already read to keep memory constant
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+    except etree.XMLSyntaxError: # Nothing recoverable
+        return None, []
+    return last_page, circle_ids
+
+# =======================
+# Circle pages
+# =======================
+
+@dataclass
+class CircleRecord:
+    """Fields of a circle xml page, as found in the page"""
+    name: Optional[str] = None
+    pen_names: list[str] = field(default_factory=list)
+    space: Optional[str] = None
+    websites: list[str] = field(default_factory=list)
+    shops: list[str] = field(default_factory=list)
+    twitter: Optional[str] = None
+    pixiv: Optional[str] = None
+    niconico: Optional[str] = None
+    tags: list[dict[str, str]] = field(default_factory=list)
+    genre: Optional[str] = None
+    cut: Optional[str] = None
+    cut_web: Optional[str] = None
+    promotional_videos: list[str] = field(default_factory=list)
+    goods: list[str] = field(default_factory=list)
+    other_goods: list[str] = field(default_factory=list)
+    images: list[dict[str, str]] = field(default_factory=list)
+    email: Optional[str] = None
+    promotional_images: list[str] = field(default_factory=list)
+    promotional_links: list[dict[str, str]] = field(default_factory=list)
+    description: Optional[str] = None
+    unknown_tags: list[str] = field(default_factory=list) # Tags without handler, in order of appearance
+
+def get_text(element: etree._Element) -> str:
+    """Text of element and its descendants, each piece stripped (as bs4 get_text(strip=True))"""
+    return "".join(text.strip() for text in element.itertext())
+
+def _set_first_text(name: str) -> Callable[[CircleRecord, etree._Element], None]:
+    def handler(record: CircleRecord, element: etree._Element) -> None:
+        if getattr(record, name) is None: # First one only
+            setattr(record, name, get_text(element))
+    return handler
+
+def _append_text(name: str) -> Callable[[CircleRecord, etree._Element], None]:
+    def handler(record: CircleRecord, element: etree._Element) -> None:
+        getattr(record, name).append(get_text(element))
+    return handler
+
+def _append_attrs(name: str) -> Callable[[CircleRecord, etree._Element], None]:
+    def handler(record: CircleRecord, element: etree._Element) -> None:
+        getattr(record, name).append(dict(element.attrib))
+    return handler
+
+CIRCLE_HANDLERS: dict[str, Callable[[CircleRecord, etree._Element], None]] = {
+    "サークル名": _set_first_text("name"),
+    "執筆者名": _append_text("pen_names"),
+    "配置スペース": _set_first_text("space"),
+    "Webサイト": _append_text("websites"),
+    "通販サイト": _append_text("shops"),
+    "TwitterId": _set_first_text("twitter"),
+    "pixivId": _set_first_text("pixiv"),
+    "niconicoId": _set_first_text("niconico"),
+    "タグ": _append_attrs("tags"),
+    "ジャンル名": _set_first_text("genre"),
+    "申込用画像": _set_first_text("cut"),
+    "Webカタログ用画像": _set_first_text("cut_web"),
+    "宣伝用動画": _append_text("promotional_videos"),
+    "頒布物": _append_text("goods"),
+    "その他頒布物": _append_text("other_goods"),
+    "新着画像": _append_attrs("images"),
+    "公開メールアドレス": _set_first_text("email"),
+    "宣伝用画像": _append_text("promotional_images"),
+    "宣伝用Url": _append_attrs("promotional_links"),
+    "補足説明": _set_first_text("description"),
+}
+
+def parse_circle(data: bytes) -> Optional[CircleRecord]:
+    """Read the first Circle of a circle xml page walking its children once, None if there is no Circle"""
+    try:
+        root = etree.fromstring(data, parser=etree.XMLParser(recover=True))
+    except etree.XMLSyntaxError: # Nothing recoverable
+        return None
+    if root is None:
+        return None
+    circle = next(root.iter("{*}Circle"), None)
+    if circle is None:
+        return None
+
+    record = CircleRecord()
+    if circle.text and circle.text.strip():
+        record.unknown_tags.append("#text")
+    for element in circle:
+        if element.tail and element.tail.strip():
+            record.unknown_tags.append("#text")
+        if not isinstance(element.tag, str): # Comments, processing instructions
+            continue
+        name = etree.QName(element).localname
+        handler = CIRCLE_HANDLERS.get(name)
+        if handler is None:
+            record.unknown_tags.append(name)
+        else:
+            handler(record, element)
+    return record
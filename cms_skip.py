@@ -2,10 +2,106 @@
 Decides whether the url should be skipped
 """
 import re
+import json
 import atexit
 from pathlib import Path
 from logging import Logger
-from typing import Optional
+from typing import Iterable, Literal, Optional
+from urllib.parse import urlsplit, urlunsplit
+from cms_index import FsyncPolicy, KahIndexBackend, KahTextIndexBackend
+
+PATH_SKIP_RULES = Path(__file__).parent / "skip_rules.json"
+DEFAULT_SKIP_RULES = { # Used when no rules file is found
+    "regexes": [{"pattern": r"https://i\d\.secure\.pixiv\.net/", "reason": "Blacklisted domain (known dead)."}],
+}
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+def get_canonical_url(url: str) -> str:
+    """url with lowercase scheme and host, no default port nor fragment and sorted query, so that equivalent urls compare equal"""
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    try:
+        port = parts.port
+    except ValueError: # Invalid port, leave it as is
+        return url
+    netloc = (parts.hostname or "").lower()
+    if ":" in netloc: # IPv6
+        netloc = f"[{netloc}]"
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        netloc += f":{port}"
+    if "@" in parts.netloc:
+        netloc = parts.netloc.rsplit("@", 1)[0] + "@" + netloc
+    path = parts.path or ("/" if netloc else "")
+    query = "&".join(sorted(parts.query.split("&"))) if parts.query else ""
+    return urlunsplit((scheme, netloc, path, query, ""))
+
+class KahSkipRule:
+    """One blacklist rule"""
+    def __init__(self, kind: Literal["host_suffix", "prefix", "regex"], pattern: str, reason: str = "Blacklisted.") -> None:
+        self.kind = kind
+        self.pattern = pattern
+        self.reason = reason
+
+    def __repr__(self) -> str:
+        return f"KahSkipRule({self.kind}={self.pattern!r})"
+
+class KahSkipRules:
+    """Blacklist of urls, compiled for cheap matching.
+
+    Rules file is a json dict with optional lists "host_suffixes" (e.g. "example.com" matches example.com and its
+    subdomains), "prefixes" (url prefixes) and "regexes" (searched in the url, case insensitive). Each entry is either
+    the pattern or a dict {"pattern": ..., "reason": ...}."""
+
+    def __init__(self, rules: list[KahSkipRule]) -> None:
+        self.rules = rules
+        self.host_suffixes: dict[str, KahSkipRule] = {}
+        self.prefixes: dict[str, list[KahSkipRule]] = {} # host -> prefix rules for that host
+        regex_rules: list[KahSkipRule] = []
+        for rule in rules:
+            if rule.kind == "host_suffix":
+                self.host_suffixes.setdefault(rule.pattern.lower().strip("."), rule)
+            elif rule.kind == "prefix":
+                self.prefixes.setdefault((urlsplit(rule.pattern).hostname or "").lower(), []).append(rule)
+            else:
+                regex_rules.append(rule)
+        # One alternation, the matching rule is found back through its group name
+        self.regex_rules = {f"r{i}": rule for i, rule in enumerate(regex_rules)}
+        self.regex = re.compile("|".join(f"(?P<{name}>{rule.pattern})" for name, rule in self.regex_rules.items()), re.IGNORECASE) if regex_rules else None
+
+    @classmethod
+    def load(cls, path: Path = PATH_SKIP_RULES) -> "KahSkipRules":
+        """Load rules from json file at path, or DEFAULT_SKIP_RULES if it does not exist"""
+        config = DEFAULT_SKIP_RULES
+        if path.exists():
+            with open(path, "r", encoding="utf-8") as f:
+                config = json.load(f)
+        rules = []
+        for key, kind in (("host_suffixes", "host_suffix"), ("prefixes", "prefix"), ("regexes", "regex")):
+            for entry in config.get(key, []):
+                if isinstance(entry, str):
+                    rules.append(KahSkipRule(kind, entry))
+                else:
+                    rules.append(KahSkipRule(kind, entry["pattern"], entry.get("reason", "Blacklisted.")))
+        return cls(rules)
+
+    def match(self, url: str) -> KahSkipRule | None:
+        """First rule matching url, host rules first"""
+        host = (urlsplit(url).hostname or "").lower()
+        if self.host_suffixes:
+            labels = host.split(".")
+            for i in range(len(labels)):
+                rule = self.host_suffixes.get(".".join(labels[i:]))
+                if rule is not None:
+                    return rule
+        for rule in self.prefixes.get(host, ()):
+            if url.startswith(rule.pattern):
+                return rule
+        if self.regex is not None:
+            m = self.regex.search(url)
+            if m is not None:
+                return self.regex_rules[m.lastgroup]
+        return None
 
 class KahSkipManager:
     """Skip fetching urls given some criteria"""
@@ -15,11 +111,12 @@ class KahSkipManager:
 
     def should_skip_url(self, url: str) -> str | None:
         """If url should be skipped, return reason else None"""
-        if url in self.downloaded_urls:
+        if self.is_downloaded(url):
             return "Already downloaded."
         # Other
-        if re.search(r'https://i\d\.secure\.pixiv\.net/', url, re.IGNORECASE):
-            return "Blacklisted domain (known dead)."
+        rule = self.rules.match(url)
+        if rule is not None:
+            return f"{rule.reason} ({rule})"
         
         return None
 
@@ -30,42 +127,61 @@ class KahSkipManager:
     def __init__(self, 
                  path_index: Path = Path(__file__).parent / "downloaded_index.txt", 
                  save_at_exit: bool = True,
-                 logger: Optional[Logger] = None) -> None:
-        """Skip fetching urls given some criteria"""
+                 logger: Optional[Logger] = None,
+                 flush_size: int = 64,
+                 flush_interval: float = 1.0,
+                 fsync_policy: FsyncPolicy = "never",
+                 backend: Optional[KahIndexBackend] = None,
+                 rules: Optional[KahSkipRules] = None) -> None:
+        """Skip fetching urls given some criteria.
+        
+        Downloaded urls are stored by backend, by default a text index at path_index written in groups as configured
+        by flush_size, flush_interval and fsync_policy (see KahIndexBackend). Pending urls are flushed on close,
+        which is registered atexit. Blacklist rules are loaded from skip_rules.json if not given.
+
+        Urls are stored by their canonical key (see get_canonical_url), urls stored as is by older runs still match."""
         self.path_index = path_index
-        self.downloaded_urls = set()
         self.logger = logger
+        self.rules = rules if rules is not None else KahSkipRules.load()
+        if backend is None:
+            backend = KahTextIndexBackend(path_index, flush_size=flush_size, flush_interval=flush_interval,
+                                          fsync_policy=fsync_policy, logger=logger)
+        self.backend = backend
+        atexit.register(self.close)
         if save_at_exit:
             if self.logger:
                 self.logger.debug("Registering atexit save for downloaded urls.")
             atexit.register(self.save_downloaded_urls)
 
-        # Load it if exists
-        if self.path_index.exists():
-            if self.logger:
-                self.logger.debug(f"Loading downloaded urls from index file at path={self.path_index}.")
-            with open(self.path_index, "r", encoding="utf-8") as f:
-                self.downloaded_urls = set(f.read().splitlines())
-        else: # create
-            if self.logger:
-                self.logger.debug(f"Creating new downloaded urls index file at path={self.path_index}.")
-            self.path_index.parent.mkdir(parents=True, exist_ok=True)
-            with open(self.path_index, "w+", encoding="utf-8") as f:
-                f.write("")
+    @staticmethod
+    def get_key(url: str) -> str:
+        """Key of url in the downloaded index"""
+        return get_canonical_url(url)
 
-    def mark_url_as_downloaded(self, url: str) -> None:
-        """Mark a URL as downloaded."""
-        if self.logger:
-            self.logger.debug(f"Marking URL as downloaded: url={url}")
-        self.downloaded_urls.add(url)
-        with open(self.path_index, "a+", encoding="utf-8") as f:
-            f.write(url + "\n")
+    def is_downloaded(self, url: str) -> bool:
+        """Whether url is in the downloaded index"""
+        key = self.get_key(url)
+        return self.backend.contains(key) or (key != url and self.backend.contains(url))
 
-    def save_downloaded_urls(self) -> None:
-        """Save the downloaded URLs to the index file."""
+    def mark_url_as_downloaded(self, url: str, aliases: Iterable[str] = ()) -> None:
+        """Mark a URL as downloaded, along with the other urls it is known by (e.g. before redirects)."""
+        keys = list(dict.fromkeys(self.get_key(u) for u in (url, *aliases)))
         if self.logger:
-            self.logger.info(f"Saving downloaded URLs to index file at path={self.path_index}.")
-        self.path_index.parent.mkdir(parents=True, exist_ok=True)
-        with open(self.path_index, "w", encoding="utf-8") as f:
-            f.writelines(url + "\n" for url in sorted(self.downloaded_urls))
+            self.logger.debug(f"Marking URL as downloaded: url={url}" + (f" (aliases {keys[1:]})" if len(keys) > 1 else ""))
+        if len(keys) == 1:
+            self.backend.add(keys[0])
+        else:
+            self.backend.add_many(keys)
+
+    def flush(self) -> None:
+        """Write pending downloaded URLs to the index."""
+        self.backend.flush()
 
+    def close(self) -> None:
+        """Flush pending downloaded URLs and release the index."""
+        self.backend.close()
+
+    def save_downloaded_urls(self) -> None:
+        """Save the downloaded URLs to the index, compacting it if the backend supports it."""
+        self.backend.compact()
+        self.backend.close()
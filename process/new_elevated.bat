@@ -13,6 +13,13 @@ if %errorlevel% neq 0 (
 REM Link content
 mklink /H "%~dp0%NEWFOLDER%\cms_lib.py" "%~dp0..\cms_lib.py"
 mklink /H "%~dp0%NEWFOLDER%\cms_skip.py" "%~dp0..\cms_skip.py"
+mklink /H "%~dp0%NEWFOLDER%\cms_engine.py" "%~dp0..\cms_engine.py"
+mklink /H "%~dp0%NEWFOLDER%\cms_index.py" "%~dp0..\cms_index.py"
+mklink /H "%~dp0%NEWFOLDER%\cms_fetch.py" "%~dp0..\cms_fetch.py"
+mklink /H "%~dp0%NEWFOLDER%\cms_parse.py" "%~dp0..\cms_parse.py"
+mklink /H "%~dp0%NEWFOLDER%\cms_archive.py" "%~dp0..\cms_archive.py"
+mklink /H "%~dp0%NEWFOLDER%\cms_frontier.py" "%~dp0..\cms_frontier.py"
+mklink /H "%~dp0%NEWFOLDER%\skip_rules.json" "%~dp0..\skip_rules.json"
 mklink /J "%~dp0%NEWFOLDER%\kahscrape" "%~dp0..\kahscrape"
 
 endlocal